@@ -1,22 +1,35 @@
 from fastapi import APIRouter, Depends, HTTPException
+from pydantic import TypeAdapter
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import text
+from sqlalchemy import text, select, update, func
 from pathlib import Path
+import logging
+import sqlparse
 
 from ..db import get_db
 from .. import models, schemas
+from . import credits
+from .subscriptions import invalidate_plans_cache
+from app.middleware.subscription import invalidate_free_plan
 from app.auth import get_current_user
 
+# Authentication is enforced by the router-level dependency. FastAPI caches
+# get_current_user per request, so handlers that need the user can still
+# declare it without triggering a second lookup.
 router = APIRouter(
     prefix="/api/admin",
     tags=["Admin"],
     dependencies=[Depends(get_current_user)]
 )
 
+logger = logging.getLogger(__name__)
+
+# Built once so list responses are validated in a single pass
+_credit_cost_list_adapter = TypeAdapter(list[schemas.CreditCostResponse])
+
 @router.post("/run-migration")
 async def run_migration(
-    db: AsyncSession = Depends(get_db),
-    current_user: models.User = Depends(get_current_user)
+    db: AsyncSession = Depends(get_db)
 ):
     """
     Run the subscription system database migration
@@ -34,20 +47,48 @@ async def run_migration(
         with open(migration_file, 'r') as f:
             sql = f.read()
         
-        # Split by semicolon and execute each statement
-        statements = [s.strip() for s in sql.split(';') if s.strip() and not s.strip().startswith('--')]
+        # Split into statements so we can report (and fall back to) them individually;
+        # sqlparse understands string literals, comments and dollar-quoted DO blocks
+        statements = [
+            s.strip() for s in sqlparse.split(sql)
+            if sqlparse.format(s, strip_comments=True).strip()
+        ]
         
         executed = []
-        for statement in statements:
-            if statement and 'DO $$' not in statement:  # Skip DO blocks for now
+        try:
+            # Everything runs in the session's transaction. The first statement
+            # goes through SQLAlchemy, which begins that transaction on the
+            # connection; the rest of the script follows in one round-trip
+            # (asyncpg only accepts multi-statement scripts on the raw
+            # connection, as prepared statements hold a single command)
+            connection = await db.connection()
+            if statements:
+                await connection.exec_driver_sql(statements[0])
+            if len(statements) > 1:
+                raw_connection = await connection.get_raw_connection()
+                await raw_connection.driver_connection.execute("\n".join(statements[1:]))
+            executed = [statement[:50] + "..." for statement in statements]
+        except Exception as e:
+            # Undo the partially applied script, then fall back to
+            # per-statement execution to isolate failures
+            logger.warning("Bulk migration failed, retrying per statement: %s", e)
+            await db.rollback()
+            for statement in statements:
                 try:
-                    await db.execute(text(statement))
+                    # A savepoint per statement, so one failure does not abort
+                    # the transaction for the statements after it
+                    async with db.begin_nested():
+                        await db.execute(text(statement))
                     executed.append(statement[:50] + "...")
                 except Exception as e:
                     # Log but continue (some statements may already be executed)
-                    print(f"Statement warning: {e}")
+                    logger.warning("Migration statement failed: %s", e)
         
         await db.commit()
+        # The migration seeds plans and credit costs
+        await invalidate_plans_cache()
+        invalidate_free_plan()
+        credits._cost_cache.clear()
         
         return {
             "message": "Migration completed",
@@ -70,20 +111,22 @@ async def grant_credits(
     """Manually grant credits to a user"""
     # TODO: Add admin role check
     
-    from sqlalchemy import select
-    
-    # Get user's subscription
+    # Add credits and read back the new balance in one statement
     result = await db.execute(
-        select(models.Subscription).where(models.Subscription.user_id == user_id)
+        update(models.Subscription)
+        .where(models.Subscription.user_id == user_id)
+        .values(credits_remaining=models.Subscription.credits_remaining + amount)
+        .returning(
+            models.Subscription.id,
+            models.Subscription.credits_remaining,
+            models.Subscription.credits_rollover
+        )
     )
-    subscription = result.scalar_one_or_none()
+    subscription = result.first()
     
     if not subscription:
         raise HTTPException(status_code=404, detail="User subscription not found")
     
-    # Add credits
-    subscription.credits_remaining += amount
-    
     # Create transaction record
     transaction = models.CreditTransaction(
         user_id=user_id,
@@ -104,14 +147,11 @@ async def grant_credits(
 
 @router.get("/analytics")
 async def get_analytics(
-    db: AsyncSession = Depends(get_db),
-    current_user: models.User = Depends(get_current_user)
+    db: AsyncSession = Depends(get_db)
 ):
     """Get subscription analytics"""
     # TODO: Add admin role check
     
-    from sqlalchemy import select, func
-    
     # Count subscriptions by plan
     subs_by_plan = await db.execute(
         select(
@@ -128,13 +168,16 @@ async def get_analytics(
         for row in subs_by_plan.all()
     ]
     
-    # Total users
-    total_users_result = await db.execute(select(func.count(models.User.id)))
-    total_users = total_users_result.scalar()
-    
-    # Total subscriptions
-    total_subs_result = await db.execute(select(func.count(models.Subscription.id)))
-    total_subs = total_subs_result.scalar()
+    # Total users and subscriptions in a single round-trip
+    totals_result = await db.execute(
+        select(
+            select(func.count(models.User.id)).scalar_subquery().label('total_users'),
+            select(func.count(models.Subscription.id)).scalar_subquery().label('total_subs')
+        )
+    )
+    totals = totals_result.one()
+    total_users = totals.total_users
+    total_subs = totals.total_subs
     
     return {
         "total_users": total_users,
@@ -147,32 +190,26 @@ async def get_analytics(
 
 @router.get("/credit-costs", response_model=list)
 async def get_all_credit_costs(
-    db: AsyncSession = Depends(get_db),
-    current_user: models.User = Depends(get_current_user)
+    db: AsyncSession = Depends(get_db)
 ):
     """Get all credit cost configurations"""
     # TODO: Add admin role check
     
-    from sqlalchemy import select
-    
     result = await db.execute(
         select(models.CreditCost).order_by(models.CreditCost.operation_type)
     )
     costs = result.scalars().all()
     
-    return [schemas.CreditCostResponse.model_validate(cost) for cost in costs]
+    return _credit_cost_list_adapter.validate_python(costs)
 
 @router.get("/credit-costs/{operation_type}")
 async def get_credit_cost(
     operation_type: str,
-    db: AsyncSession = Depends(get_db),
-    current_user: models.User = Depends(get_current_user)
+    db: AsyncSession = Depends(get_db)
 ):
     """Get credit cost for a specific operation"""
     # TODO: Add admin role check
     
-    from sqlalchemy import select
-    
     result = await db.execute(
         select(models.CreditCost).where(models.CreditCost.operation_type == operation_type)
     )
@@ -187,31 +224,32 @@ async def get_credit_cost(
 async def update_credit_cost(
     operation_type: str,
     update_data: schemas.CreditCostUpdate,
-    db: AsyncSession = Depends(get_db),
-    current_user: models.User = Depends(get_current_user)
+    db: AsyncSession = Depends(get_db)
 ):
     """Update credit cost for an operation"""
     # TODO: Add admin role check
     
-    from sqlalchemy import select
+    values = {"cost": update_data.cost}
+    if update_data.description is not None:
+        values["description"] = update_data.description
+    if update_data.is_active is not None:
+        values["is_active"] = update_data.is_active
     
     result = await db.execute(
-        select(models.CreditCost).where(models.CreditCost.operation_type == operation_type)
+        update(models.CreditCost)
+        .where(models.CreditCost.operation_type == operation_type)
+        .values(**values)
+        .returning(models.CreditCost)
     )
     cost = result.scalar_one_or_none()
     
     if not cost:
         raise HTTPException(status_code=404, detail=f"Credit cost not found for: {operation_type}")
     
-    # Update fields
-    cost.cost = update_data.cost
-    if update_data.description is not None:
-        cost.description = update_data.description
-    if update_data.is_active is not None:
-        cost.is_active = update_data.is_active
-    
     await db.commit()
-    await db.refresh(cost)
+    
+    # Drop the cached cost so consumers pick up the new value
+    credits._cost_cache.pop(operation_type, None)
     
     return {
         "message": f"Credit cost updated for {operation_type}",
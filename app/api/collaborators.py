@@ -1,7 +1,8 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, insert, update
 from typing import List
+from pydantic import TypeAdapter
 from app.db import get_db
 from app import models, schemas
 from app.auth import get_current_user
@@ -12,6 +13,8 @@ router = APIRouter(
     tags=["collaborators"]
 )
 
+_collaborator_list_adapter = TypeAdapter(List[schemas.CollaboratorResponse])
+
 @router.post("/", response_model=schemas.CollaboratorResponse)
 async def invite_collaborator(
     doc_id: int,
@@ -20,48 +23,55 @@ async def invite_collaborator(
     current_user: models.User = Depends(get_current_user)
 ):
     """Invite a collaborator to a document"""
-    # Get document and verify ownership
-    result = await db.execute(select(models.Document).where(models.Document.id == doc_id))
-    doc = result.scalar_one_or_none()
-    if not doc:
+    # Get document, invited user and existing membership in one query
+    already_collaborator = (
+        select(models.DocumentCollaborator.id)
+        .where(
+            models.DocumentCollaborator.document_id == doc_id,
+            models.DocumentCollaborator.user_id == models.User.id
+        )
+        .exists()
+    )
+    result = await db.execute(
+        select(models.Document, models.User, already_collaborator.label("already"))
+        .select_from(models.Document)
+        .join(models.User, models.User.email == invite.email, isouter=True)
+        .where(models.Document.id == doc_id)
+    )
+    row = result.first()
+    if not row:
         raise HTTPException(status_code=404, detail="Document not found")
     
+    doc, invited_user, already = row
+    
     if doc.owner_id != current_user.id:
         raise HTTPException(status_code=403, detail="Only document owner can invite collaborators")
     
     # Check collaborator limit
     await check_collaborator_limit(doc_id, current_user, db)
     
-    # Find user by email
-    user_result = await db.execute(select(models.User).where(models.User.email == invite.email))
-    invited_user = user_result.scalar_one_or_none()
-    
     if not invited_user:
         raise HTTPException(status_code=404, detail=f"User with email {invite.email} not found")
     
     if invited_user.id == current_user.id:
         raise HTTPException(status_code=400, detail="Cannot invite yourself")
     
-    # Check if already a collaborator
-    existing = await db.execute(
-        select(models.DocumentCollaborator).where(
-            models.DocumentCollaborator.document_id == doc_id,
-            models.DocumentCollaborator.user_id == invited_user.id
-        )
-    )
-    if existing.scalar_one_or_none():
+    if already:
         raise HTTPException(status_code=400, detail="User is already a collaborator")
     
     # Create collaborator
-    collaborator = models.DocumentCollaborator(
-        document_id=doc_id,
-        user_id=invited_user.id,
-        role=invite.role,
-        invited_by=current_user.id
+    result = await db.execute(
+        insert(models.DocumentCollaborator)
+        .values(
+            document_id=doc_id,
+            user_id=invited_user.id,
+            role=invite.role,
+            invited_by=current_user.id
+        )
+        .returning(models.DocumentCollaborator)
     )
-    db.add(collaborator)
+    collaborator = result.scalar_one()
     await db.commit()
-    await db.refresh(collaborator)
     
     # Build response with user info
     return schemas.CollaboratorResponse(
@@ -88,30 +98,23 @@ async def get_collaborators(
     if not doc:
         raise HTTPException(status_code=404, detail="Document not found")
     
-    # Get collaborators with user info
+    # Get collaborators with user info, projecting only the response fields
     result = await db.execute(
-        select(models.DocumentCollaborator, models.User)
+        select(
+            models.DocumentCollaborator.id,
+            models.DocumentCollaborator.document_id,
+            models.DocumentCollaborator.user_id,
+            models.DocumentCollaborator.role,
+            models.DocumentCollaborator.invited_by,
+            models.DocumentCollaborator.created_at,
+            models.User.email.label("user_email"),
+            models.User.full_name.label("user_name")
+        )
         .join(models.User, models.DocumentCollaborator.user_id == models.User.id)
         .where(models.DocumentCollaborator.document_id == doc_id)
     )
     
-    collaborators_with_users = result.all()
-    
-    # Build response
-    response = []
-    for collab, user in collaborators_with_users:
-        response.append(schemas.CollaboratorResponse(
-            id=collab.id,
-            document_id=collab.document_id,
-            user_id=collab.user_id,
-            role=collab.role,
-            invited_by=collab.invited_by,
-            created_at=collab.created_at,
-            user_email=user.email,
-            user_name=user.full_name
-        ))
-    
-    return response
+    return _collaborator_list_adapter.validate_python(result.mappings().all())
 
 @router.delete("/{user_id}")
 async def remove_collaborator(
@@ -151,48 +154,71 @@ async def remove_collaborator(
 async def update_collaborator_role(
     doc_id: int,
     user_id: int,
-    update: schemas.CollaboratorUpdate,
+    update_data: schemas.CollaboratorUpdate,
     db: AsyncSession = Depends(get_db),
     current_user: models.User = Depends(get_current_user)
 ):
     """Update a collaborator's role"""
-    # Get document and verify ownership
-    doc_result = await db.execute(select(models.Document).where(models.Document.id == doc_id))
-    doc = doc_result.scalar_one_or_none()
-    if not doc:
-        raise HTTPException(status_code=404, detail="Document not found")
-    
-    if doc.owner_id != current_user.id:
-        raise HTTPException(status_code=403, detail="Only document owner can update collaborator roles")
-    
-    # Find collaborator
-    collab_result = await db.execute(
-        select(models.DocumentCollaborator, models.User)
-        .join(models.User, models.DocumentCollaborator.user_id == models.User.id)
+    # Update the role (only if the current user owns the document) and
+    # read back the document owner and collaborator's user info in one query
+    owns_document = (
+        select(models.Document.id)
+        .where(
+            models.Document.id == doc_id,
+            models.Document.owner_id == current_user.id
+        )
+        .exists()
+    )
+    updated = (
+        update(models.DocumentCollaborator)
         .where(
             models.DocumentCollaborator.document_id == doc_id,
-            models.DocumentCollaborator.user_id == user_id
+            models.DocumentCollaborator.user_id == user_id,
+            owns_document
+        )
+        .values(role=update_data.role)
+        .returning(
+            models.DocumentCollaborator.id,
+            models.DocumentCollaborator.document_id,
+            models.DocumentCollaborator.user_id,
+            models.DocumentCollaborator.role,
+            models.DocumentCollaborator.invited_by,
+            models.DocumentCollaborator.created_at
+        )
+        .cte("updated")
+    )
+    result = await db.execute(
+        select(
+            models.Document.owner_id,
+            updated,
+            models.User.email,
+            models.User.full_name
         )
+        .select_from(models.Document)
+        .join(updated, updated.c.document_id == models.Document.id, isouter=True)
+        .join(models.User, models.User.id == updated.c.user_id, isouter=True)
+        .where(models.Document.id == doc_id)
     )
-    result_tuple = collab_result.first()
+    row = result.first()
     
-    if not result_tuple:
-        raise HTTPException(status_code=404, detail="Collaborator not found")
+    if not row:
+        raise HTTPException(status_code=404, detail="Document not found")
     
-    collaborator, user = result_tuple
+    if row.owner_id != current_user.id:
+        raise HTTPException(status_code=403, detail="Only document owner can update collaborator roles")
+    
+    if row.id is None:
+        raise HTTPException(status_code=404, detail="Collaborator not found")
     
-    # Update role
-    collaborator.role = update.role
     await db.commit()
-    await db.refresh(collaborator)
     
     return schemas.CollaboratorResponse(
-        id=collaborator.id,
-        document_id=collaborator.document_id,
-        user_id=collaborator.user_id,
-        role=collaborator.role,
-        invited_by=collaborator.invited_by,
-        created_at=collaborator.created_at,
-        user_email=user.email,
-        user_name=user.full_name
+        id=row.id,
+        document_id=row.document_id,
+        user_id=row.user_id,
+        role=row.role,
+        invited_by=row.invited_by,
+        created_at=row.created_at,
+        user_email=row.email,
+        user_name=row.full_name
     )
@@ -1,11 +1,15 @@
 from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, and_, func, desc
+from sqlalchemy import select, update, insert, and_, func, desc, true, literal, bindparam, lambda_stmt
+from sqlalchemy.dialects.postgresql import aggregate_order_by
 from typing import List
-from datetime import datetime, timedelta
+import time
+import orjson
 
-from ..db import get_db
+from ..db import get_db, async_session_maker
 from .. import models, schemas
+from ..services import stripe_service
 from app.auth import get_current_user
 
 router = APIRouter(
@@ -14,6 +18,26 @@ router = APIRouter(
     dependencies=[Depends(get_current_user)]
 )
 
+# In-process cache of credit costs: operation_type -> (cost, cached_at)
+_cost_cache: dict[str, tuple[int, float]] = {}
+COST_CACHE_TTL = 60  # seconds
+
+# Hot-path statements built once; executed with bound parameters so both
+# SQLAlchemy's compiled cache and asyncpg's prepared statement cache are hit
+SUBSCRIPTION_WITH_PLAN_STMT = lambda_stmt(
+    lambda: select(models.Subscription, models.Plan)
+    .join(models.Plan, models.Subscription.plan_id == models.Plan.id)
+    .where(models.Subscription.user_id == bindparam("user_id"))
+)
+ACTIVE_CREDIT_COST_STMT = lambda_stmt(
+    lambda: select(models.CreditCost).where(
+        and_(
+            models.CreditCost.operation_type == bindparam("operation_type"),
+            models.CreditCost.is_active == True
+        )
+    )
+)
+
 @router.get("/balance", response_model=schemas.CreditBalance)
 async def get_balance(
     db: AsyncSession = Depends(get_db),
@@ -21,18 +45,14 @@ async def get_balance(
 ):
     """Get current credit balance"""
     result = await db.execute(
-        select(models.Subscription).where(models.Subscription.user_id == current_user.id)
+        SUBSCRIPTION_WITH_PLAN_STMT, {"user_id": current_user.id}
     )
-    subscription = result.scalar_one_or_none()
+    row = result.first()
     
-    if not subscription:
+    if not row:
         raise HTTPException(status_code=404, detail="No subscription found")
     
-    # Get plan details
-    plan_result = await db.execute(
-        select(models.Plan).where(models.Plan.id == subscription.plan_id)
-    )
-    plan = plan_result.scalar_one()
+    subscription, plan = row
     
     return schemas.CreditBalance(
         credits_remaining=subscription.credits_remaining,
@@ -46,19 +66,32 @@ async def get_balance(
 async def get_transactions(
     limit: int = 50,
     offset: int = 0,
-    db: AsyncSession = Depends(get_db),
     current_user: models.User = Depends(get_current_user)
 ):
-    """Get credit transaction history"""
-    result = await db.execute(
-        select(models.CreditTransaction)
-        .where(models.CreditTransaction.user_id == current_user.id)
-        .order_by(desc(models.CreditTransaction.created_at))
-        .limit(limit)
-        .offset(offset)
-    )
-    transactions = result.scalars().all()
-    return transactions
+    """Get credit transaction history, streamed as a JSON array"""
+    user_id = current_user.id
+    
+    async def stream_transactions():
+        # Use a dedicated session: request-scoped dependencies are closed
+        # before a streaming response body is sent
+        async with async_session_maker() as session:
+            result = await session.stream_scalars(
+                select(models.CreditTransaction)
+                .where(models.CreditTransaction.user_id == user_id)
+                .order_by(desc(models.CreditTransaction.created_at))
+                .limit(limit)
+                .offset(offset)
+                .execution_options(yield_per=100)
+            )
+            yield b"["
+            separator = b""
+            async for transaction in result:
+                item = schemas.CreditTransactionResponse.model_validate(transaction)
+                yield separator + orjson.dumps(item.model_dump())
+                separator = b","
+            yield b"]"
+    
+    return StreamingResponse(stream_transactions(), media_type="application/json")
 
 @router.post("/purchase", response_model=dict)
 async def purchase_credits(
@@ -87,8 +120,6 @@ async def purchase_credits(
         raise HTTPException(status_code=404, detail="No subscription found")
     
     # Create or get Stripe customer
-    from ..services import stripe_service
-    
     if not subscription.stripe_customer_id:
         customer = await stripe_service.create_customer(
             user_email=current_user.email,
@@ -122,76 +153,91 @@ async def get_usage_stats(
     current_user: models.User = Depends(get_current_user)
 ):
     """Get monthly usage statistics"""
-    # Get subscription
-    sub_result = await db.execute(
-        select(models.Subscription).where(models.Subscription.user_id == current_user.id)
-    )
-    subscription = sub_result.scalar_one_or_none()
+    # Subscription, plan, period usage and top operations in a single query
+    transaction = models.CreditTransaction
+    operation = transaction.metadata_json['operation_type'].as_string()
     
-    if not subscription:
-        raise HTTPException(status_code=404, detail="No subscription found")
-    
-    # Get plan
-    plan_result = await db.execute(
-        select(models.Plan).where(models.Plan.id == subscription.plan_id)
+    sub = (
+        select(
+            models.Subscription.current_period_start,
+            func.coalesce(models.Subscription.current_period_end, func.now()).label('current_period_end'),
+            models.Subscription.credits_remaining,
+            models.Subscription.credits_rollover,
+            models.Plan.credits_per_month
+        )
+        .join(models.Plan, models.Subscription.plan_id == models.Plan.id)
+        .where(models.Subscription.user_id == current_user.id)
+        .cte('sub')
     )
-    plan = plan_result.scalar_one()
-    
-    # Calculate credits used in current period
-    period_start = subscription.current_period_start
-    period_end = subscription.current_period_end or datetime.utcnow()
-    
-    # Get usage transactions in current period
-    usage_result = await db.execute(
-        select(func.sum(models.CreditTransaction.amount))
+    usage = (
+        select(func.sum(transaction.amount).label('credits_used'))
         .where(
             and_(
-                models.CreditTransaction.user_id == current_user.id,
-                models.CreditTransaction.transaction_type == 'usage',
-                models.CreditTransaction.created_at >= period_start,
-                models.CreditTransaction.created_at <= period_end
+                transaction.user_id == current_user.id,
+                transaction.transaction_type == 'usage',
+                transaction.created_at >= sub.c.current_period_start,
+                transaction.created_at <= sub.c.current_period_end
             )
         )
+        .cte('usage')
     )
-    credits_used_value = usage_result.scalar()
-    credits_used = abs(credits_used_value) if credits_used_value else 0
-    
-    # Get top operations
-    top_ops_result = await db.execute(
+    top = (
         select(
-            models.CreditTransaction.metadata_json['operation_type'].astext.label('operation'),
+            operation.label('operation'),
             func.count().label('count'),
-            func.sum(func.abs(models.CreditTransaction.amount)).label('total_credits')
+            func.sum(func.abs(transaction.amount)).label('total_credits')
         )
         .where(
             and_(
-                models.CreditTransaction.user_id == current_user.id,
-                models.CreditTransaction.transaction_type == 'usage',
-                models.CreditTransaction.created_at >= period_start
+                transaction.user_id == current_user.id,
+                transaction.transaction_type == 'usage',
+                transaction.created_at >= sub.c.current_period_start
             )
         )
-        .group_by(models.CreditTransaction.metadata_json['operation_type'].astext)
+        .group_by('operation')
         .order_by(desc('total_credits'))
         .limit(5)
+        .cte('top')
+    )
+    top_json = (
+        select(
+            func.jsonb_agg(
+                aggregate_order_by(
+                    func.jsonb_build_object(
+                        'operation', func.coalesce(top.c.operation, 'unknown'),
+                        'count', top.c.count,
+                        'credits_used', func.coalesce(top.c.total_credits, 0)
+                    ),
+                    top.c.total_credits.desc()
+                )
+            ).label('top_operations')
+        )
+        .cte('top_json')
     )
-    top_operations = [
-        {
-            "operation": row.operation or "unknown",
-            "count": row.count,
-            "credits_used": row.total_credits or 0
-        }
-        for row in top_ops_result.all()
-    ]
+    
+    result = await db.execute(
+        select(sub, usage.c.credits_used, top_json.c.top_operations)
+        .select_from(sub.join(usage, true()).join(top_json, true()))
+    )
+    stats = result.mappings().first()
+    
+    if not stats:
+        raise HTTPException(status_code=404, detail="No subscription found")
+    
+    period_start = stats['current_period_start']
+    period_end = stats['current_period_end']
+    credits_used = abs(stats['credits_used']) if stats['credits_used'] else 0
+    top_operations = stats['top_operations'] or []
     
     # Calculate usage percentage
-    total_allocated = plan.credits_per_month + subscription.credits_rollover
+    total_allocated = stats['credits_per_month'] + stats['credits_rollover']
     usage_percentage = (credits_used / total_allocated * 100) if total_allocated > 0 else 0
     
     return schemas.UsageStatsResponse(
         current_period_start=period_start,
         current_period_end=period_end,
         credits_used=credits_used,
-        credits_remaining=subscription.credits_remaining,
+        credits_remaining=stats['credits_remaining'],
         total_credits_allocated=total_allocated,
         usage_percentage=round(usage_percentage, 2),
         top_operations=top_operations
@@ -203,54 +249,86 @@ async def consume_credits(
     operation_type: str,
     description: str,
     metadata: dict = None,
-    db: AsyncSession = None
+    db: AsyncSession = None,
+    commit: bool = True
 ):
     """
     Internal function to consume credits
     Used by other endpoints that need credit validation
+    Pass commit=False to leave the deduction in the caller's transaction
     """
-    # Get subscription
+    subscription = models.Subscription
+    
+    # Current balance, reported when the deduction is refused
+    balance = (
+        select(subscription.credits_remaining, subscription.credits_rollover)
+        .where(subscription.user_id == user_id)
+        .cte("balance")
+    )
+    # Deduct credits (prefer using rollover credits first); the balance check
+    # lives in the WHERE clause so concurrent consumers cannot overdraw
+    deducted = (
+        update(subscription)
+        .where(
+            subscription.user_id == user_id,
+            subscription.credits_remaining + subscription.credits_rollover >= amount
+        )
+        .values(
+            credits_rollover=func.greatest(subscription.credits_rollover - amount, 0),
+            credits_remaining=subscription.credits_remaining - func.greatest(amount - subscription.credits_rollover, 0)
+        )
+        .returning(subscription.id, subscription.credits_remaining, subscription.credits_rollover)
+        .cte("deducted")
+    )
+    # Create transaction record
+    recorded = (
+        insert(models.CreditTransaction)
+        .from_select(
+            ["user_id", "subscription_id", "amount", "transaction_type", "description", "metadata_json"],
+            select(
+                literal(user_id),
+                deducted.c.id,
+                literal(-amount),  # Negative for consumption
+                literal('usage'),
+                literal(description),
+                literal(metadata or {}, models.CreditTransaction.metadata_json.type)
+            )
+        )
+        .returning(models.CreditTransaction.id)
+        .cte("recorded")
+    )
+    
     result = await db.execute(
-        select(models.Subscription).where(models.Subscription.user_id == user_id)
+        select(
+            balance.c.credits_remaining,
+            balance.c.credits_rollover,
+            (deducted.c.credits_remaining + deducted.c.credits_rollover).label("new_balance"),
+            recorded.c.id
+        )
+        .select_from(
+            balance
+            .join(deducted, true(), isouter=True)
+            .join(recorded, true(), isouter=True)
+        )
     )
-    subscription = result.scalar_one_or_none()
+    row = result.first()
     
-    if not subscription:
+    if not row:
         raise HTTPException(status_code=404, detail="No subscription found")
     
-   # Check if enough credits
-    total_available = subscription.credits_remaining + subscription.credits_rollover
-    if total_available < amount:
+    if row.new_balance is None:
+        total_available = row.credits_remaining + row.credits_rollover
         raise HTTPException(
             status_code=402,  # Payment Required
             detail=f"Insufficient credits. Required: {amount}, Available: {total_available}"
         )
     
-    # Deduct credits (prefer using rollover credits first)
-    if subscription.credits_rollover >= amount:
-        subscription.credits_rollover -= amount
-    else:
-        remainder = amount - subscription.credits_rollover
-        subscription.credits_rollover = 0
-        subscription.credits_remaining -= remainder
-    
-    # Create transaction record
-    transaction = models.CreditTransaction(
-        user_id=user_id,
-        subscription_id=subscription.id,
-        amount=-amount,  # Negative for consumption
-        transaction_type='usage',
-        description=description,
-        metadata_json=metadata or {}
-    )
-    db.add(transaction)
-    
-    await db.commit()
-    await db.refresh(subscription)
+    if commit:
+        await db.commit()
     
     return {
         "credits_consumed": amount,
-        "credits_remaining": subscription.credits_remaining + subscription.credits_rollover
+        "credits_remaining": row.new_balance
     }
 
 async def get_credit_cost(operation_type: str, db: AsyncSession) -> int:
@@ -258,13 +336,12 @@ async def get_credit_cost(operation_type: str, db: AsyncSession) -> int:
     Get the credit cost for a specific operation type from database
     Returns the cost, or raises error if not found
     """
+    cached = _cost_cache.get(operation_type)
+    if cached and time.monotonic() - cached[1] < COST_CACHE_TTL:
+        return cached[0]
+    
     result = await db.execute(
-        select(models.CreditCost).where(
-            and_(
-                models.CreditCost.operation_type == operation_type,
-                models.CreditCost.is_active == True
-            )
-        )
+        ACTIVE_CREDIT_COST_STMT, {"operation_type": operation_type}
     )
     credit_cost = result.scalar_one_or_none()
     
@@ -274,4 +351,5 @@ async def get_credit_cost(operation_type: str, db: AsyncSession) -> int:
             detail=f"Credit cost configuration not found for operation: {operation_type}"
         )
     
+    _cost_cache[operation_type] = (credit_cost.cost, time.monotonic())
     return credit_cost.cost
@@ -1,12 +1,20 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, status
+from fastapi.responses import StreamingResponse
+from pydantic import TypeAdapter
+from sqlalchemy import select, exists
 from sqlalchemy.ext.asyncio import AsyncSession
-from typing import List, Dict, Any
+from sqlalchemy.exc import SQLAlchemyError
+from typing import List, Dict, Any, Awaitable, Callable
+import hashlib
+import time
 from app.db import get_db
+from app.cache import get_redis
 from app import models, schemas
 from app.auth import get_current_user
 from app.middleware.subscription import check_document_limit, check_collaborator_limit
 from app.services.document_service import DocumentService
 from app.services.comment_service import CommentService
+from app.services.ai import generate_suggestion, submit_suggestion, stream_suggestion
 
 router = APIRouter(
     prefix="/api/documents",
@@ -14,11 +22,164 @@ router = APIRouter(
 )
 
 
+# Cached GET bodies are served without touching the DB while fresh, and
+# kept a while longer as a fallback if the database becomes unavailable
+DOCUMENT_CACHE_FRESH_TTL = 30  # seconds
+DOCUMENT_CACHE_STALE_TTL = 300  # seconds
+
+_comment_list_adapter = TypeAdapter(List[schemas.CommentResponse])
+
+
+def _etag_response(request: Request, etag: str, body: str) -> Response:
+    """Return 304 if the client already has this body, else the body with its ETag."""
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+
+async def _cached_response(
+    request: Request,
+    key: str,
+    load_body: Callable[[], Awaitable[str]]
+) -> Response:
+    """
+    Serve a JSON body through the Redis cache with ETag support.
+    
+    Args:
+        request: The incoming request (for If-None-Match)
+        key: Redis hash key holding etag, body and fresh_until
+        load_body: Coroutine factory producing the serialized body from the DB
+        
+    Returns:
+        Response with an ETag header, or 304 Not Modified
+    """
+    redis_client = None
+    entry: Dict[str, str] = {}
+    try:
+        redis_client = await get_redis()
+        entry = await redis_client.hgetall(key)
+    except Exception:
+        redis_client = None
+    
+    if entry and time.time() < float(entry["fresh_until"]):
+        return _etag_response(request, entry["etag"], entry["body"])
+    
+    try:
+        body = await load_body()
+    except SQLAlchemyError:
+        if entry:
+            # Database unavailable: serve the stale copy
+            return _etag_response(request, entry["etag"], entry["body"])
+        raise
+    
+    etag = f'"{hashlib.md5(body.encode()).hexdigest()}"'
+    if redis_client:
+        try:
+            async with redis_client.pipeline(transaction=True) as pipe:
+                pipe.hset(key, mapping={
+                    "etag": etag,
+                    "body": body,
+                    "fresh_until": time.time() + DOCUMENT_CACHE_FRESH_TTL
+                })
+                pipe.expire(key, DOCUMENT_CACHE_STALE_TTL)
+                await pipe.execute()
+        except Exception:
+            pass
+    
+    return _etag_response(request, etag, body)
+
+
+async def _invalidate(*keys: str) -> None:
+    """Drop cached GET bodies after a write."""
+    try:
+        redis_client = await get_redis()
+        await redis_client.delete(*keys)
+    except Exception:
+        pass
+
+
 def get_document_service(db: AsyncSession = Depends(get_db)) -> DocumentService:
     """Dependency to get DocumentService instance."""
     return DocumentService(db)
 
 
+# Short-lived doc_id -> owner_id mapping, so access checks are a Redis GET
+DOCUMENT_OWNER_CACHE_TTL = 30  # seconds
+
+
+async def authorize_document(
+    doc_id: int,
+    current_user: models.User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+) -> int:
+    """
+    Dependency ensuring the current user may access a document.
+    
+    Args:
+        doc_id: Document ID
+        current_user: Authenticated user
+        db: Database session
+        
+    Returns:
+        The document owner's user ID
+        
+    Raises:
+        HTTPException: If the document is not found, or the user is
+            neither its owner nor a collaborator
+    """
+    key = f"doc_owner:{doc_id}"
+    owner_id = None
+    try:
+        redis_client = await get_redis()
+        cached = await redis_client.get(key)
+        if cached is not None:
+            owner_id = int(cached)
+    except Exception:
+        redis_client = None
+    
+    if owner_id is None:
+        result = await db.execute(
+            select(models.Document.owner_id).where(models.Document.id == doc_id)
+        )
+        owner_id = result.scalar_one_or_none()
+        if owner_id is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Document not found"
+            )
+        if redis_client:
+            try:
+                await redis_client.setex(key, DOCUMENT_OWNER_CACHE_TTL, owner_id)
+            except Exception:
+                pass
+    
+    if owner_id != current_user.id:
+        result = await db.execute(
+            select(
+                exists().where(
+                    models.DocumentCollaborator.document_id == doc_id,
+                    models.DocumentCollaborator.user_id == current_user.id
+                )
+            )
+        )
+        if not result.scalar():
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Not authorized to access this document"
+            )
+    
+    return owner_id
+
+
+async def get_document_or_404(
+    doc_id: int,
+    _owner_id: int = Depends(authorize_document),
+    doc_service: DocumentService = Depends(get_document_service)
+) -> models.Document:
+    """Dependency loading an accessible document, once per request."""
+    return await doc_service.get_document(doc_id)
+
+
 def get_comment_service(db: AsyncSession = Depends(get_db)) -> CommentService:
     """Dependency to get CommentService instance."""
     return CommentService(db)
@@ -44,8 +205,8 @@ async def create_document(
 
 @router.get("/", response_model=schemas.PaginatedResponse[schemas.DocumentResponse])
 async def get_documents(
-    page: int = 1,
-    size: int = 10,
+    page: int = Query(1, ge=1),
+    size: int = Query(10, ge=1, le=100),
     current_user: models.User = Depends(get_current_user),
     doc_service: DocumentService = Depends(get_document_service)
 ) -> Dict[str, Any]:
@@ -60,46 +221,70 @@ async def get_documents(
 @router.get("/{doc_id}", response_model=schemas.DocumentResponse)
 async def get_document(
     doc_id: int,
+    request: Request,
+    _owner_id: int = Depends(authorize_document),
     doc_service: DocumentService = Depends(get_document_service)
-) -> models.Document:
+) -> Response:
     """Get a specific document by ID."""
-    return await doc_service.get_document(doc_id)
+    async def load_body() -> str:
+        doc = await doc_service.get_document(doc_id)
+        return schemas.DocumentResponse.model_validate(doc).model_dump_json()
+    
+    return await _cached_response(request, f"doc:{doc_id}", load_body)
+
+
+@router.get("/{doc_id}/content")
+async def get_document_content(
+    doc_id: int,
+    _owner_id: int = Depends(authorize_document),
+    doc_service: DocumentService = Depends(get_document_service)
+) -> StreamingResponse:
+    """Stream a document's raw content as plain text."""
+    return StreamingResponse(doc_service.stream_content(doc_id), media_type="text/plain")
 
 
 @router.put("/{doc_id}", response_model=schemas.DocumentResponse)
 async def update_document(
     doc_id: int,
     doc_update: schemas.DocumentUpdate,
+    doc: models.Document = Depends(get_document_or_404),
     current_user: models.User = Depends(get_current_user),
     doc_service: DocumentService = Depends(get_document_service)
 ) -> models.Document:
     """Update a document's title and/or content."""
-    return await doc_service.update_document(
-        doc_id=doc_id,
+    doc = await doc_service.update_document(
+        doc=doc,
         title=doc_update.title,
         content=doc_update.content,
         created_by=current_user.id
     )
+    await _invalidate(f"doc:{doc_id}")
+    return doc
 
 
 @router.patch("/{doc_id}/title", response_model=schemas.DocumentResponse)
 async def update_document_title(
     doc_id: int,
     title_update: schemas.DocumentTitleUpdate,
+    _owner_id: int = Depends(authorize_document),
     doc_service: DocumentService = Depends(get_document_service)
 ) -> models.Document:
     """Update only the document title."""
-    return await doc_service.update_title(doc_id, title_update.title)
+    doc = await doc_service.update_title(doc_id, title_update.title)
+    await _invalidate(f"doc:{doc_id}")
+    return doc
 
 
 @router.delete("/{doc_id}")
 async def delete_document(
     doc_id: int,
+    doc: models.Document = Depends(get_document_or_404),
     current_user: models.User = Depends(get_current_user),
     doc_service: DocumentService = Depends(get_document_service)
 ) -> Dict[str, str]:
     """Delete a document."""
-    await doc_service.delete_document(doc_id, current_user.id)
+    await doc_service.delete_document(doc, current_user.id)
+    await _invalidate(f"doc:{doc_id}", f"doc_comments:{doc_id}", f"doc_owner:{doc_id}")
     return {"message": "Document deleted successfully"}
 
 
@@ -119,8 +304,9 @@ async def create_document_from_upload(
 @router.get("/{doc_id}/versions", response_model=List[schemas.DocumentVersionResponse])
 async def get_versions(
     doc_id: int,
+    _owner_id: int = Depends(authorize_document),
     doc_service: DocumentService = Depends(get_document_service)
-) -> List[Dict[str, Any]]:
+) -> List[models.DocumentVersion]:
     """Get version history for a document."""
     return await doc_service.get_versions(doc_id)
 
@@ -129,6 +315,7 @@ async def get_versions(
 async def add_comment(
     doc_id: int,
     comment: schemas.CommentCreate,
+    _owner_id: int = Depends(authorize_document),
     current_user: models.User = Depends(get_current_user),
     db: AsyncSession = Depends(get_db),
     comment_service: CommentService = Depends(get_comment_service)
@@ -137,38 +324,74 @@ async def add_comment(
     # Check collaborator limit
     await check_collaborator_limit(doc_id, current_user, db)
     
-    return await comment_service.create_comment(
+    new_comment = await comment_service.create_comment(
         document_id=doc_id,
         user_id=current_user.id,
         content=comment.content,
         position_start=comment.position_start,
         position_end=comment.position_end
     )
+    await _invalidate(f"doc_comments:{doc_id}")
+    return new_comment
 
 
 @router.get("/{doc_id}/comments", response_model=List[schemas.CommentResponse])
 async def get_comments(
     doc_id: int,
+    request: Request,
+    _owner_id: int = Depends(authorize_document),
     comment_service: CommentService = Depends(get_comment_service)
-) -> List[models.Comment]:
+) -> Response:
     """Get all comments for a document."""
-    return await comment_service.get_comments(doc_id)
+    async def load_body() -> str:
+        comments = await comment_service.get_comments(doc_id)
+        return _comment_list_adapter.dump_json(comments).decode()
+    
+    return await _cached_response(request, f"doc_comments:{doc_id}", load_body)
 
 
 @router.post("/{doc_id}/ai-suggest")
 async def get_ai_suggestions(
     doc_id: int,
     request: dict,
+    response: Response,
+    doc: models.Document = Depends(get_document_or_404),
     current_user: models.User = Depends(get_current_user),
     doc_service: DocumentService = Depends(get_document_service)
 ) -> Dict[str, Any]:
-    """Get AI-powered suggestions for document text."""
+    """
+    Request AI-powered suggestions for document text.
+    
+    The suggestion is generated in the background: this returns 202 with a
+    job ID whose result is read from the stream endpoint. If the job queue
+    is unavailable the suggestion is generated inline and returned directly.
+    """
     context = request.get("context", "")
     selection = request.get("selection", "")
     
-    return await doc_service.get_ai_suggestions(
-        doc_id=doc_id,
-        context=context,
-        selection=selection,
-        user_id=current_user.id
+    await doc_service.charge_ai_suggestion(doc, current_user.id)
+    
+    try:
+        job_id = await submit_suggestion(doc_id, context, selection)
+    except Exception:
+        return await generate_suggestion(context, selection)
+    
+    response.status_code = status.HTTP_202_ACCEPTED
+    return {
+        "job_id": job_id,
+        "stream_url": f"/api/documents/{doc_id}/ai-suggest/{job_id}/stream"
+    }
+
+
+@router.get("/{doc_id}/ai-suggest/{job_id}/stream")
+async def stream_ai_suggestions(
+    doc_id: int,
+    job_id: str,
+    _owner_id: int = Depends(authorize_document)
+) -> StreamingResponse:
+    """Stream the result of an AI suggestion job as Server-Sent Events."""
+    return StreamingResponse(
+        stream_suggestion(doc_id, job_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"}
     )
@@ -1,6 +1,7 @@
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, and_, func
+from sqlalchemy import select, update, and_, func, case, exists
+from sqlalchemy.dialects.postgresql import insert
 from datetime import datetime
 import secrets
 import string
@@ -15,10 +16,45 @@ router = APIRouter(
     dependencies=[Depends(get_current_user)]
 )
 
+# Referral code alphabet, as bytes so random bytes map straight onto it
+REFERRAL_CODE_ALPHABET = (string.ascii_uppercase + string.digits).encode()
+# Random bytes at or above this are dropped so every character is equally likely
+_UNBIASED_BYTE_LIMIT = 256 - 256 % len(REFERRAL_CODE_ALPHABET)
+
 def generate_referral_code(length=8):
     """Generate a unique referral code"""
-    characters = string.ascii_uppercase + string.digits
-    return ''.join(secrets.choice(characters) for _ in range(length))
+    code = bytearray()
+    while len(code) < length:
+        code.extend(
+            REFERRAL_CODE_ALPHABET[b % len(REFERRAL_CODE_ALPHABET)]
+            for b in secrets.token_bytes(length)
+            if b < _UNBIASED_BYTE_LIMIT
+        )
+    return code[:length].decode()
+
+async def create_referral_code(db: AsyncSession, referrer_id: int) -> models.Referral:
+    """
+    Insert a new main referral code for a user in a single round-trip.
+    
+    A colliding code is skipped by ON CONFLICT DO NOTHING (nothing is
+    returned), in which case one fresh code is tried.
+    """
+    for _ in range(2):
+        result = await db.execute(
+            insert(models.Referral)
+            .values(
+                referrer_id=referrer_id,
+                referral_code=generate_referral_code(),
+                status="pending"
+            )
+            .on_conflict_do_nothing(index_elements=[models.Referral.referral_code])
+            .returning(models.Referral)
+        )
+        referral = result.scalar_one_or_none()
+        if referral:
+            await db.commit()
+            return referral
+    raise HTTPException(status_code=503, detail="Could not generate a referral code, please retry")
 
 @router.get("/me", response_model=schemas.ReferralStatsResponse)
 async def get_my_referrals(
@@ -26,47 +62,50 @@ async def get_my_referrals(
     current_user: models.User = Depends(get_current_user)
 ):
     """Get user's referral statistics"""
-    # Get or create referral code
-    result = await db.execute(
-        select(models.Referral).where(
+    # Get the user's main referral code and aggregate stats in one query
+    main_code = (
+        select(models.Referral.referral_code)
+        .where(
             and_(
                 models.Referral.referrer_id == current_user.id,
                 models.Referral.referee_id == None  # The user's main referral code
             )
-        ).limit(1)
+        )
+        .limit(1)
+        .correlate(None)
+        .scalar_subquery()
     )
-    referral = result.scalar_one_or_none()
-    
-    if not referral:
-        # Create new referral code
-        code = generate_referral_code()
-        referral = models.Referral(
-            referrer_id=current_user.id,
-            referral_code=code,
-            status="pending"
+    result = await db.execute(
+        select(
+            main_code.label("referral_code"),
+            func.count(case((models.Referral.referee_id != None, 1))).label("total_referrals"),
+            func.count(case((models.Referral.status == "rewarded", 1))).label("successful_referrals"),
+            func.count(case((models.Referral.status.in_(["pending", "completed"]), 1))).label("pending_referrals"),
+            func.coalesce(
+                func.sum(case((models.Referral.status == "rewarded", models.Referral.bonus_credits), else_=0)),
+                0
+            ).label("total_credits_earned")
         )
-        db.add(referral)
-        await db.commit()
-        await db.refresh(referral)
-    
-    # Get all referrals made by this user
-    all_referrals_result = await db.execute(
-        select(models.Referral).where(models.Referral.referrer_id == current_user.id)
+        .where(models.Referral.referrer_id == current_user.id)
     )
-    all_referrals = all_referrals_result.scalars().all()
+    stats = result.one()
     
-    # Calculate stats
-    total_referrals = len([r for r in all_referrals if r.referee_id is not None])
-    successful_referrals = len([r for r in all_referrals if r.status == "rewarded"])
-    pending_referrals = len([r for r in all_referrals if r.status in ["pending", "completed"]])
-    total_credits_earned = sum(r.bonus_credits for r in all_referrals if r.status == "rewarded")
+    referral_code = stats.referral_code
+    pending_referrals = stats.pending_referrals
+    
+    if not referral_code:
+        # Create new referral code
+        referral = await create_referral_code(db, current_user.id)
+        referral_code = referral.referral_code
+        # The new code is itself a pending referral
+        pending_referrals += 1
     
     return schemas.ReferralStatsResponse(
-        referral_code=referral.referral_code,
-        total_referrals=total_referrals,
-        successful_referrals=successful_referrals,
+        referral_code=referral_code,
+        total_referrals=stats.total_referrals,
+        successful_referrals=stats.successful_referrals,
         pending_referrals=pending_referrals,
-        total_credits_earned=total_credits_earned
+        total_credits_earned=stats.total_credits_earned
     )
 
 @router.post("/generate-code", response_model=schemas.ReferralResponse)
@@ -90,28 +129,18 @@ async def generate_code(
         return existing
     
     # Create new code
-    code = generate_referral_code()
-    referral = models.Referral(
-        referrer_id=current_user.id,
-        referral_code=code,
-        status="pending"
-    )
-    db.add(referral)
-    await db.commit()
-    await db.refresh(referral)
-    
-    return referral
+    return await create_referral_code(db, current_user.id)
 
 @router.post("/apply/{code}", response_model=dict)
 async def apply_referral_code(
-    code: str,
+    code: schemas.ReferralCode,
     db: AsyncSession = Depends(get_db),
     current_user: models.User = Depends(get_current_user)
 ):
     """Apply a referral code to receive bonus credits"""
     # Get the referral code
     result = await db.execute(
-        select(models.Referral).where(models.Referral.referral_code == code.upper())
+        select(models.Referral).where(models.Referral.referral_code == code)
     )
     referral = result.scalar_one_or_none()
     
@@ -122,56 +151,63 @@ async def apply_referral_code(
     if referral.referrer_id == current_user.id:
         raise HTTPException(status_code=400, detail="Cannot use your own referral code")
     
-    # Check if user has already used a referral code
-    existing_result = await db.execute(
-        select(models.Referral).where(models.Referral.referee_id == current_user.id)
+    # Fetch the remaining ids in one round-trip on the request session
+    ids = await db.execute(
+        select(
+            exists().where(models.Referral.referee_id == current_user.id),
+            select(models.Subscription.id)
+            .where(models.Subscription.user_id == current_user.id)
+            .scalar_subquery(),
+            select(models.Subscription.id)
+            .where(models.Subscription.user_id == referral.referrer_id)
+            .scalar_subquery()
+        )
     )
-    existing_referral = existing_result.scalar_one_or_none()
+    already_referred, referee_subscription_id, referrer_subscription_id = ids.one()
     
-    if existing_referral:
+    if already_referred:
         raise HTTPException(status_code=400, detail="You have already used a referral code")
     
     # Create a new referral record for this specific referral
     new_referral = models.Referral(
         referrer_id=referral.referrer_id,
         referee_id=current_user.id,
-        referral_code=code.upper(),
+        referral_code=code,
         status="completed",
         bonus_credits=50,  # Bonus for referee
         completed_at=datetime.utcnow()
     )
     db.add(new_referral)
+    transactions = []
     
     # Grant bonus credits to referee (the current user)
-    referee_sub_result = await db.execute(
-        select(models.Subscription).where(models.Subscription.user_id == current_user.id)
-    )
-    referee_subscription = referee_sub_result.scalar_one_or_none()
-    
-    if referee_subscription:
-        referee_subscription.credits_remaining += 50
+    if referee_subscription_id:
+        await db.execute(
+            update(models.Subscription)
+            .where(models.Subscription.id == referee_subscription_id)
+            .values(credits_remaining=models.Subscription.credits_remaining + 50)
+        )
         
         # Create credit transaction
         referee_transaction = models.CreditTransaction(
             user_id=current_user.id,
-            subscription_id=referee_subscription.id,
+            subscription_id=referee_subscription_id,
             amount=50,
             transaction_type="bonus",
             description=f"Referral bonus from code {code}",
             metadata_json={"referral_code": code, "type": "referee_bonus"}
         )
-        db.add(referee_transaction)
+        transactions.append(referee_transaction)
     
     # Grant bonus credits to referrer
-    referrer_sub_result = await db.execute(
-        select(models.Subscription).where(models.Subscription.user_id == referral.referrer_id)
-    )
-    referrer_subscription = referrer_sub_result.scalar_one_or_none()
-    
-    if referrer_subscription:
+    if referrer_subscription_id:
         # Referrer gets 1 month free Pro (or equivalent credits)
         # For simplicity, giving 500 bonus credits
-        referrer_subscription.credits_remaining += 500
+        await db.execute(
+            update(models.Subscription)
+            .where(models.Subscription.id == referrer_subscription_id)
+            .values(credits_remaining=models.Subscription.credits_remaining + 500)
+        )
         
         # Update referral status
         referral.status = "rewarded"
@@ -180,14 +216,16 @@ async def apply_referral_code(
         # Create credit transaction for referrer
         referrer_transaction = models.CreditTransaction(
             user_id=referral.referrer_id,
-            subscription_id=referrer_subscription.id,
+            subscription_id=referrer_subscription_id,
             amount=500,
             transaction_type="bonus",
             description=f"Referral reward - {current_user.email} signed up",
             metadata_json={"referee_id": current_user.id, "type": "referrer_bonus"}
         )
-        db.add(referrer_transaction)
+        transactions.append(referrer_transaction)
     
+    # Both transactions go out in a single multi-row INSERT
+    db.add_all(transactions)
     await db.commit()
     
     return {
@@ -1,13 +1,13 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, status
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
-from typing import List
+from sqlalchemy import select, func
+import asyncio
 # from uuid import UUID
-from app.db import get_db
+from app.db import get_db, async_session_maker
 from app.models import User, Upload, AuditResult
-from app.schemas import ProcessRequest, AuditResultResponse
+from app.schemas import ProcessRequest, AuditResultResponse, PaginatedResponse
 from app.auth import get_current_user
-from app.services.huggingface import hf_service
+from app.services.analysis_batcher import analysis_batcher
 from app.services.processing import read_file_content
 
 router = APIRouter(prefix="/api/results", tags=["Results"])
@@ -38,35 +38,59 @@ async def process_document(
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No text provided")
     
     # Process with LLM
-    analysis_result = await hf_service.analyze_text(text_to_process)
+    analysis_result = await analysis_batcher.analyze(text_to_process, current_user.id)
     
     # Save result
     audit_result = AuditResult(
         user_id=current_user.id,
         upload_id=request.upload_id,
-        input_text=text_to_process[:500],  # Store first 500 chars
+        # Uploaded text is read back from the upload; only inline text is kept
+        input_text=None if request.upload_id else text_to_process[:500],
         result_json=analysis_result,
         status=analysis_result.get("status", "completed")
     )
     
     db.add(audit_result)
     await db.commit()
-    await db.refresh(audit_result)
     
     return audit_result
 
-@router.get("/", response_model=List[AuditResultResponse])
+@router.get("/", response_model=PaginatedResponse[AuditResultResponse])
 async def get_results(
+    page: int = Query(1, ge=1),
+    size: int = Query(10, ge=1, le=100),
     current_user: User = Depends(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
-    result = await db.execute(
-        select(AuditResult)
-        .where(AuditResult.user_id == current_user.id)
-        .order_by(AuditResult.created_at.desc())
-    )
-    results = result.scalars().all()
-    return results
+    offset = (page - 1) * size
+    
+    # Get total count (on its own session) concurrently with the page
+    async def count_results() -> int:
+        async with async_session_maker() as session:
+            count_result = await session.execute(
+                select(func.count()).select_from(AuditResult).where(AuditResult.user_id == current_user.id)
+            )
+            return count_result.scalar_one()
+    
+    async def fetch_page():
+        result = await db.execute(
+            select(AuditResult)
+            .where(AuditResult.user_id == current_user.id)
+            .order_by(AuditResult.created_at.desc())
+            .offset(offset)
+            .limit(size)
+        )
+        return result.scalars().all()
+    
+    total, results = await asyncio.gather(count_results(), fetch_page())
+    
+    return {
+        "items": results,
+        "total": total,
+        "page": page,
+        "size": size,
+        "pages": (total + size - 1) // size
+    }
 
 @router.get("/{result_id}", response_model=AuditResultResponse)
 async def get_result(
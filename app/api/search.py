@@ -1,6 +1,6 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, or_
+from sqlalchemy import select, or_, union_all, literal, null, cast, Integer, String, Text
 from app.db import get_db
 from app.models import User, Document, Upload
 from app.schemas import DocumentResponse, UploadWithStatusResponse
@@ -28,32 +28,94 @@ async def search(
         
     search_term = f"%{q}%"
     
-    docs = []
-    uploads = []
-    
-    if type in ["all", "documents"]:
-        doc_query = (
-            select(Document)
-            .where(
-                Document.owner_id == current_user.id,
-                Document.title.ilike(search_term)
-            )
-            .limit(limit)
+    doc_query = (
+        select(Document)
+        .where(
+            Document.owner_id == current_user.id,
+            Document.title.ilike(search_term)
         )
-        doc_result = await db.execute(doc_query)
-        docs = doc_result.scalars().all()
-        
-    if type in ["all", "uploads"]:
-        upload_query = (
-            select(Upload)
-            .where(
-                Upload.user_id == current_user.id,
-                Upload.original_filename.ilike(search_term)
-            )
-            .limit(limit)
+        .limit(limit)
+    )
+    upload_query = (
+        select(Upload)
+        .where(
+            Upload.user_id == current_user.id,
+            Upload.original_filename.ilike(search_term)
         )
+        .limit(limit)
+    )
+    
+    if type == "documents":
+        doc_result = await db.execute(doc_query)
+        return {"documents": doc_result.scalars().all(), "uploads": []}
+    
+    if type == "uploads":
         upload_result = await db.execute(upload_query)
-        uploads = upload_result.scalars().all()
+        return {"documents": [], "uploads": upload_result.scalars().all()}
+    
+    # Fetch both result sets in one round-trip, tagged with their kind
+    docs_part = (
+        select(
+            literal("document").label("kind"),
+            Document.id,
+            Document.title.label("name"),
+            Document.content,
+            Document.owner_id,
+            cast(null(), Integer).label("file_size"),
+            cast(null(), String).label("status"),
+            cast(null(), Text).label("error_message"),
+            Document.created_at,
+            Document.updated_at
+        )
+        .where(
+            Document.owner_id == current_user.id,
+            Document.title.ilike(search_term)
+        )
+        .limit(limit)
+    )
+    uploads_part = (
+        select(
+            literal("upload").label("kind"),
+            Upload.id,
+            Upload.original_filename.label("name"),
+            cast(null(), Text).label("content"),
+            Upload.user_id.label("owner_id"),
+            Upload.file_size,
+            Upload.status,
+            Upload.error_message,
+            Upload.created_at,
+            Upload.updated_at
+        )
+        .where(
+            Upload.user_id == current_user.id,
+            Upload.original_filename.ilike(search_term)
+        )
+        .limit(limit)
+    )
+    result = await db.execute(union_all(docs_part, uploads_part))
+    
+    docs = []
+    uploads = []
+    for row in result.all():
+        if row.kind == "document":
+            docs.append({
+                "id": row.id,
+                "title": row.name,
+                "content": row.content,
+                "owner_id": row.owner_id,
+                "created_at": row.created_at,
+                "updated_at": row.updated_at
+            })
+        else:
+            uploads.append({
+                "id": row.id,
+                "original_filename": row.name,
+                "file_size": row.file_size,
+                "status": row.status,
+                "error_message": row.error_message,
+                "created_at": row.created_at,
+                "updated_at": row.updated_at
+            })
         
     return {
         "documents": docs,
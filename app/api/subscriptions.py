@@ -1,30 +1,96 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Header, Response
+from pydantic import TypeAdapter
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, and_
-from typing import List
+from sqlalchemy import select, update, and_, bindparam, lambda_stmt
+from sqlalchemy.orm import joinedload
+from typing import List, Optional
 from datetime import datetime, timedelta
 
 from ..db import get_db
 from .. import models, schemas
+from ..services import stripe_service
 from app.auth import get_current_user
+from app.middleware.subscription import invalidate_plan_limits, get_free_plan
+from app.cache import get_redis, idempotent_request
 
+# Authentication is enforced by the router-level dependency (this is what
+# protects /plans). FastAPI caches get_current_user per request, so handlers
+# declaring it again reuse the same user instead of decoding the token and
+# loading the user twice.
 router = APIRouter(
     prefix="/api/subscriptions",
     tags=["Subscriptions"],
     dependencies=[Depends(get_current_user)]
 )
 
+# Hot-path statements built once; executed with bound parameters so both
+# SQLAlchemy's compiled cache and asyncpg's prepared statement cache are hit
+SUBSCRIPTION_BY_USER_STMT = lambda_stmt(
+    lambda: select(models.Subscription).where(models.Subscription.user_id == bindparam("user_id"))
+)
+SUBSCRIPTION_WITH_PLAN_BY_USER_STMT = lambda_stmt(
+    lambda: select(models.Subscription)
+    .options(joinedload(models.Subscription.plan))
+    .where(models.Subscription.user_id == bindparam("user_id"))
+)
+PLAN_BY_NAME_STMT = lambda_stmt(
+    lambda: select(models.Plan).where(models.Plan.name == bindparam("name"))
+)
+# Everything the balance endpoint returns, totalled in the projection
+CREDIT_BALANCE_STMT = lambda_stmt(
+    lambda: select(
+        models.Subscription.credits_remaining,
+        models.Subscription.credits_rollover,
+        (models.Subscription.credits_remaining + models.Subscription.credits_rollover).label("total_credits"),
+        models.Plan.credits_per_month.label("plan_credits_per_month"),
+        models.Subscription.current_period_end.label("next_renewal_date")
+    )
+    .join(models.Plan, models.Plan.id == models.Subscription.plan_id)
+    .where(models.Subscription.user_id == bindparam("user_id"))
+)
+ACTIVE_PLANS_STMT = lambda_stmt(
+    lambda: select(models.Plan).where(models.Plan.is_active == True).order_by(models.Plan.id)
+)
+
+# The active plan list is effectively static; cache the serialized body
+PLANS_CACHE_KEY = "plans:active:v1"
+PLANS_CACHE_TTL = 300  # seconds
+
+_plan_list_adapter = TypeAdapter(List[schemas.PlanResponse])
+
+async def invalidate_plans_cache() -> None:
+    """Drop the cached plan list after plans change"""
+    try:
+        redis_client = await get_redis()
+        await redis_client.delete(PLANS_CACHE_KEY)
+    except Exception:
+        pass
+
 @router.get("/plans", response_model=List[schemas.PlanResponse])
 async def get_plans(
-    db: AsyncSession = Depends(get_db),
-    current_user: models.User = Depends(get_current_user)
+    db: AsyncSession = Depends(get_db)
 ):
     """Get all available subscription plans"""
-    result = await db.execute(
-        select(models.Plan).where(models.Plan.is_active == True).order_by(models.Plan.id)
-    )
+    redis_client = None
+    try:
+        redis_client = await get_redis()
+        cached = await redis_client.get(PLANS_CACHE_KEY)
+        if cached is not None:
+            return Response(content=cached, media_type="application/json")
+    except Exception:
+        redis_client = None
+    
+    result = await db.execute(ACTIVE_PLANS_STMT)
     plans = result.scalars().all()
-    return plans
+    body = _plan_list_adapter.dump_json(plans)
+    
+    if redis_client:
+        try:
+            await redis_client.setex(PLANS_CACHE_KEY, PLANS_CACHE_TTL, body)
+        except Exception:
+            pass
+    
+    return Response(content=body, media_type="application/json")
 
 @router.get("/me", response_model=schemas.SubscriptionResponse)
 async def get_my_subscription(
@@ -33,16 +99,13 @@ async def get_my_subscription(
 ):
     """Get current user's subscription details"""
     result = await db.execute(
-        select(models.Subscription).where(models.Subscription.user_id == current_user.id)
+        SUBSCRIPTION_WITH_PLAN_BY_USER_STMT, {"user_id": current_user.id}
     )
     subscription = result.scalar_one_or_none()
     
     if not subscription:
         # Auto-create free subscription for existing users
-        plan_result = await db.execute(
-            select(models.Plan).where(models.Plan.name == "free")
-        )
-        free_plan = plan_result.scalar_one_or_none()
+        free_plan = await get_free_plan(db)
         
         if not free_plan:
             raise HTTPException(status_code=500, detail="Free plan not initialized")
@@ -58,12 +121,6 @@ async def get_my_subscription(
         await db.refresh(subscription)
         subscription.plan = free_plan
         return subscription
-
-    # Fetch the plan details
-    plan_result = await db.execute(
-        select(models.Plan).where(models.Plan.id == subscription.plan_id)
-    )
-    subscription.plan = plan_result.scalar_one()
     
     return subscription
 
@@ -71,15 +128,38 @@ async def get_my_subscription(
 async def upgrade_subscription(
     upgrade_request: schemas.SubscriptionUpgradeRequest,
     db: AsyncSession = Depends(get_db),
-    current_user: models.User = Depends(get_current_user)
+    current_user: models.User = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None)
 ):
     """
     Upgrade to a paid plan
     Returns Stripe checkout URL for payment
+    Retries with the same Idempotency-Key (or body) reuse the checkout session
     """
+    idempotent = await idempotent_request(
+        current_user.id, "subscriptions:upgrade", idempotency_key, upgrade_request
+    )
+    if idempotent.cached is not None:
+        return idempotent.cached
+    
+    try:
+        response = await _create_upgrade_checkout(upgrade_request, db, current_user)
+    except Exception:
+        await idempotent.fail()
+        raise
+    
+    await idempotent.finish(response)
+    return response
+
+async def _create_upgrade_checkout(
+    upgrade_request: schemas.SubscriptionUpgradeRequest,
+    db: AsyncSession,
+    current_user: models.User
+) -> dict:
+    """Create the Stripe checkout session for an upgrade"""
     # Get the requested plan
     result = await db.execute(
-        select(models.Plan).where(models.Plan.name == upgrade_request.plan_name)
+        PLAN_BY_NAME_STMT, {"name": upgrade_request.plan_name}
     )
     new_plan = result.scalar_one_or_none()
     
@@ -91,7 +171,7 @@ async def upgrade_subscription(
     
     # Get current subscription
     sub_result = await db.execute(
-        select(models.Subscription).where(models.Subscription.user_id == current_user.id)
+        SUBSCRIPTION_BY_USER_STMT, {"user_id": current_user.id}
     )
     subscription = sub_result.scalar_one_or_none()
     
@@ -103,8 +183,6 @@ async def upgrade_subscription(
         raise HTTPException(status_code=400, detail="Already subscribed to this plan")
     
     # Create or get Stripe customer
-    from ..services import stripe_service
-    
     if not subscription.stripe_customer_id:
         # Create Stripe customer
         customer = await stripe_service.create_customer(
@@ -140,6 +218,38 @@ async def upgrade_subscription(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to create checkout session: {str(e)}")
 
+async def _end_paid_subscription(
+    db: AsyncSession,
+    user_id: int,
+    free_plan: models.Plan,
+    **values
+) -> Optional[datetime]:
+    """
+    Apply values to the user's subscription in one UPDATE unless it is
+    already on the free plan
+    Returns the subscription's current_period_end
+    """
+    result = await db.execute(
+        update(models.Subscription)
+        .where(
+            models.Subscription.user_id == user_id,
+            models.Subscription.plan_id != free_plan.id
+        )
+        .values(**values)
+        .returning(models.Subscription.current_period_end)
+    )
+    row = result.first()
+    
+    if not row:
+        # Nothing updated: find out why
+        sub_result = await db.execute(SUBSCRIPTION_BY_USER_STMT, {"user_id": user_id})
+        if not sub_result.scalar_one_or_none():
+            raise HTTPException(status_code=404, detail="No subscription found")
+        raise HTTPException(status_code=400, detail="Already on free plan")
+    
+    await db.commit()
+    return row.current_period_end
+
 @router.post("/downgrade", response_model=dict)
 async def downgrade_subscription(
     db: AsyncSession = Depends(get_db),
@@ -149,36 +259,22 @@ async def downgrade_subscription(
     Downgrade to free plan
     Takes effect at the end of current billing period
     """
-    # Get current subscription
-    result = await db.execute(
-        select(models.Subscription).where(models.Subscription.user_id == current_user.id)
-    )
-    subscription = result.scalar_one_or_none()
-    
-    if not subscription:
-        raise HTTPException(status_code=404, detail="No subscription found")
-    
     # Get free plan
-    free_plan_result = await db.execute(
-        select(models.Plan).where(models.Plan.name == "free")
-    )
-    free_plan = free_plan_result.scalar_one()
-    
-    # Check if already on free plan
-    if subscription.plan_id == free_plan.id:
-        raise HTTPException(status_code=400, detail="Already on free plan")
+    free_plan = await get_free_plan(db)
+    if not free_plan:
+        raise HTTPException(status_code=500, detail="Free plan not initialized")
     
     # Schedule downgrade for end of period
-    subscription.status = "cancelled"
-    subscription.cancelled_at = datetime.utcnow()
     # Will downgrade when current_period_end is reached
-    
-    await db.commit()
-    await db.refresh(subscription)
+    current_period_end = await _end_paid_subscription(
+        db, current_user.id, free_plan,
+        status="cancelled",
+        cancelled_at=datetime.utcnow()
+    )
     
     return {
         "message": "Downgrade scheduled",
-        "effective_date": subscription.current_period_end,
+        "effective_date": current_period_end,
         "new_plan": "free"
     }
 
@@ -189,33 +285,23 @@ async def cancel_subscription(
     current_user: models.User = Depends(get_current_user)
 ):
     """Cancel subscription (downgrades to free)"""
-    result = await db.execute(
-        select(models.Subscription).where(models.Subscription.user_id == current_user.id)
-    )
-    subscription = result.scalar_one_or_none()
-    
-    if not subscription:
-        raise HTTPException(status_code=404, detail="No subscription found")
-    
     # Get free plan
-    free_plan_result = await db.execute(
-        select(models.Plan).where(models.Plan.name == "free")
-    )
-    free_plan = free_plan_result.scalar_one()
-    
-    if subscription.plan_id == free_plan.id:
-        raise HTTPException(status_code=400, detail="Already on free plan")
+    free_plan = await get_free_plan(db)
+    if not free_plan:
+        raise HTTPException(status_code=500, detail="Free plan not initialized")
     
     if cancel_request.immediate:
         # Immediately downgrade to free
-        subscription.plan_id = free_plan.id
-        subscription.status = "active"
-        subscription.billing_cycle = None
-        subscription.stripe_subscription_id = None
-        subscription.cancelled_at = datetime.utcnow()
-        subscription.credits_remaining = free_plan.credits_per_month
-        
-        await db.commit()
+        await _end_paid_subscription(
+            db, current_user.id, free_plan,
+            plan_id=free_plan.id,
+            status="active",
+            billing_cycle=None,
+            stripe_subscription_id=None,
+            cancelled_at=datetime.utcnow(),
+            credits_remaining=free_plan.credits_per_month
+        )
+        await invalidate_plan_limits(current_user.id)
         
         return {
             "message": "Subscription cancelled immediately",
@@ -224,15 +310,16 @@ async def cancel_subscription(
         }
     else:
         # Schedule cancellation for end of period
-        subscription.status = "cancelled"
-        subscription.cancelled_at = datetime.utcnow()
-        
-        await db.commit()
+        current_period_end = await _end_paid_subscription(
+            db, current_user.id, free_plan,
+            status="cancelled",
+            cancelled_at=datetime.utcnow()
+        )
         
         return {
             "message": "Subscription cancellation scheduled",
-            "effective_date": subscription.current_period_end,
-            "access_until": subscription.current_period_end
+            "effective_date": current_period_end,
+            "access_until": current_period_end
         }
 
 @router.get("/credits", response_model=schemas.CreditBalance)
@@ -241,24 +328,10 @@ async def get_credit_balance(
     current_user: models.User = Depends(get_current_user)
 ):
     """Get current credit balance"""
-    result = await db.execute(
-        select(models.Subscription).where(models.Subscription.user_id == current_user.id)
-    )
-    subscription = result.scalar_one_or_none()
+    result = await db.execute(CREDIT_BALANCE_STMT, {"user_id": current_user.id})
+    row = result.first()
     
-    if not subscription:
+    if not row:
         raise HTTPException(status_code=404, detail="No subscription found")
     
-    # Get plan details
-    plan_result = await db.execute(
-        select(models.Plan).where(models.Plan.id == subscription.plan_id)
-    )
-    plan = plan_result.scalar_one()
-    
-    return schemas.CreditBalance(
-        credits_remaining=subscription.credits_remaining,
-        credits_rollover=subscription.credits_rollover,
-        total_credits=subscription.credits_remaining + subscription.credits_rollover,
-        plan_credits_per_month=plan.credits_per_month,
-        next_renewal_date=subscription.current_period_end
-    )
+    return schemas.CreditBalance(**row._mapping)
@@ -1,21 +1,68 @@
-from fastapi import APIRouter, Depends, UploadFile, File, HTTPException, status
-from fastapi.concurrency import run_in_threadpool
+from fastapi import APIRouter, Depends, UploadFile, File, HTTPException, Header, Query, status
+from fastapi.responses import StreamingResponse
+from pydantic import TypeAdapter
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, update, func
-from app.db import get_db
-from app.models import User, Upload, AuditResult
-from app.schemas import UploadWithStatusResponse, ProcessFileRequest, FileProcessingResponse, PaginatedResponse
+from sqlalchemy import select, update, bindparam, lambda_stmt, tuple_
+from app.db import get_db, async_session_maker
+from app.models import User, Upload
+from app.schemas import UploadWithStatusResponse, ProcessFileRequest, FileProcessingResponse, CursorPage
 from app.auth import get_current_user
-from app.services.processing import save_upload_file
-from app.services.file_processor import FileProcessor
-from app.services.huggingface import hf_service
-from typing import List
+from app.api.credits import get_credit_cost, consume_credits
+from app.cache import idempotent_request
+from app.services.processing import save_upload_file, submit_file_processing, SET_UPLOAD_STATUS_STMT
+from app.middleware.subscription import get_plan_limits
+from app.config import settings
+from typing import AsyncIterator, List, Optional, Tuple
+from datetime import datetime
+import base64
+import orjson
 from uuid import UUID
-import os
+import aiofiles.os
 
 router = APIRouter(prefix="/api/uploads", tags=["Uploads"])
 
-ALLOWED_EXTENSIONS = {".pdf", ".docx", ".txt", ".doc"}
+_upload_adapter = TypeAdapter(UploadWithStatusResponse)
+
+ALLOWED_EXTENSIONS = frozenset({"pdf", "docx", "txt", "doc"})
+FILE_TYPE_NOT_ALLOWED = (
+    f"File type not allowed. Supported: {', '.join('.' + ext for ext in sorted(ALLOWED_EXTENSIONS))}"
+)
+
+# Hot-path statements built once; executed with bound parameters so both
+# SQLAlchemy's compiled cache and asyncpg's prepared statement cache are hit
+UPLOADS_FIRST_PAGE_STMT = lambda_stmt(
+    lambda: select(Upload)
+    .where(Upload.user_id == bindparam("user_id"))
+    .order_by(Upload.created_at.desc(), Upload.id.desc())
+    .limit(bindparam("limit"))
+)
+# Keyset page: rows strictly after the (created_at, id) of the previous page
+UPLOADS_NEXT_PAGE_STMT = lambda_stmt(
+    lambda: select(Upload)
+    .where(
+        Upload.user_id == bindparam("user_id"),
+        tuple_(Upload.created_at, Upload.id) < tuple_(bindparam("last_created_at"), bindparam("last_id"))
+    )
+    .order_by(Upload.created_at.desc(), Upload.id.desc())
+    .limit(bindparam("limit"))
+)
+UPLOAD_STATUS_STMT = lambda_stmt(
+    lambda: select(Upload.status).where(
+        Upload.id == bindparam("upload_id"),
+        Upload.user_id == bindparam("user_id")
+    )
+)
+# Only pending or failed uploads can be claimed for processing
+CLAIM_UPLOAD_STMT = lambda_stmt(
+    lambda: update(Upload)
+    .where(
+        Upload.id == bindparam("upload_id"),
+        Upload.user_id == bindparam("owner_id"),
+        Upload.status.in_(["pending", "failed"])
+    )
+    .values(status="processing", error_message=None)
+    .returning(Upload)
+)
 
 @router.post("/", response_model=UploadWithStatusResponse, status_code=status.HTTP_201_CREATED)
 async def upload_file(
@@ -24,15 +71,22 @@ async def upload_file(
     db: AsyncSession = Depends(get_db)
 ):
     """Upload file without processing - status will be 'pending'"""
-    file_ext = os.path.splitext(file.filename)[1].lower()
-    if file_ext not in ALLOWED_EXTENSIONS:
+    _, dot, file_ext = (file.filename or "").rpartition(".")
+    if not dot or file_ext.lower() not in ALLOWED_EXTENSIONS:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"File type not allowed. Supported: {', '.join(ALLOWED_EXTENSIONS)}"
+            detail=FILE_TYPE_NOT_ALLOWED
         )
     
+    # The plan's size limit is enforced while streaming, so an oversized
+    # upload is rejected without being written out in full
+    max_size = settings.MAX_FILE_SIZE
+    limits = await get_plan_limits(current_user.id, db)
+    if limits and limits["max_file_size_mb"] not in (None, -1):
+        max_size = min(max_size, limits["max_file_size_mb"] * 1024 * 1024)
+    
     try:
-        file_path, file_size = await save_upload_file(file, str(current_user.id))
+        file_path, file_size = await save_upload_file(file, str(current_user.id), max_size)
         
         upload = Upload(
             user_id=current_user.id,
@@ -45,7 +99,6 @@ async def upload_file(
         
         db.add(upload)
         await db.commit()
-        await db.refresh(upload)
         
         return upload
     except ValueError as e:
@@ -54,85 +107,129 @@ async def upload_file(
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
 
 
-@router.get("/", response_model=PaginatedResponse[UploadWithStatusResponse])
+def _encode_cursor(upload: Upload) -> str:
+    """Opaque cursor pointing just past the given upload"""
+    raw = f"{upload.created_at.isoformat()}|{upload.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        created_at, upload_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), int(upload_id)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
+async def _stream_uploads_page(stmt, params: dict, limit: int) -> AsyncIterator[bytes]:
+    """
+    Serialize a page of uploads row by row as a CursorPage JSON object
+    Uses its own session as it outlives the request's session
+    """
+    async with async_session_maker() as session:
+        result = await session.stream(stmt, params)
+        yield b'{"items":['
+        
+        count = 0
+        last = None
+        next_cursor = None
+        async for upload in result.scalars():
+            if count == limit:
+                # The extra row only signals that there is a next page
+                next_cursor = _encode_cursor(last)
+                break
+            if count:
+                yield b","
+            yield _upload_adapter.dump_json(upload)
+            count += 1
+            last = upload
+        await result.close()
+        
+        yield b'],"next_cursor":' + orjson.dumps(next_cursor) + b"}"
+
+
+@router.get("/", response_model=CursorPage[UploadWithStatusResponse])
 async def get_all_uploads(
-    page: int = 1,
-    size: int = 10,
-    current_user: User = Depends(get_current_user),
-    db: AsyncSession = Depends(get_db)
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=100),
+    current_user: User = Depends(get_current_user)
 ):
-    """Get all uploaded files for current user"""
-    offset = (page - 1) * size
-    
-    # Get total count
-    count_query = select(func.count()).select_from(Upload).where(Upload.user_id == current_user.id)
-    total_result = await db.execute(count_query)
-    total = total_result.scalar_one()
+    """Get uploaded files for current user, newest first, a page at a time"""
+    # Fetch one extra row to know whether there is a next page
+    params = {"user_id": current_user.id, "limit": limit + 1}
+    if cursor:
+        params["last_created_at"], params["last_id"] = _decode_cursor(cursor)
+        stmt = UPLOADS_NEXT_PAGE_STMT
+    else:
+        stmt = UPLOADS_FIRST_PAGE_STMT
     
-    # Get items
-    query = (
-        select(Upload)
-        .where(Upload.user_id == current_user.id)
-        .order_by(Upload.created_at.desc())
-        .offset(offset)
-        .limit(size)
+    # Rows are serialized as they are read instead of building the page in memory
+    return StreamingResponse(
+        _stream_uploads_page(stmt, params, limit),
+        media_type="application/json"
     )
-    result = await db.execute(query)
-    uploads = result.scalars().all()
-    
-    return {
-        "items": uploads,
-        "total": total,
-        "page": page,
-        "size": size,
-        "pages": (total + size - 1) // size
-    }
 
 
-@router.post("/process", response_model=FileProcessingResponse)
+@router.post("/process", response_model=FileProcessingResponse, status_code=status.HTTP_202_ACCEPTED)
 async def process_file(
     request: ProcessFileRequest,
     current_user: User = Depends(get_current_user),
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_db),
+    idempotency_key: Optional[str] = Header(None)
 ):
-    """Process an uploaded file - actual processing, no mock data"""
+    """Start processing an uploaded file - actual processing, no mock data"""
+    # Only requests carrying an Idempotency-Key are deduplicated, so a failed
+    # upload can always be resubmitted
+    idempotent = await idempotent_request(current_user.id, "uploads:process", idempotency_key)
+    if idempotent.cached is not None:
+        return idempotent.cached
     
-    # Get upload record
+    try:
+        response = await _start_processing(request, current_user, db)
+    except Exception:
+        await idempotent.fail()
+        raise
+    
+    await idempotent.finish(response)
+    return response
+
+
+async def _start_processing(
+    request: ProcessFileRequest,
+    current_user: User,
+    db: AsyncSession
+) -> FileProcessingResponse:
+    """Claim an upload, charge for it and hand it to the background job"""
+    # Claim the upload: only pending or failed uploads move to processing,
+    # so two concurrent requests cannot both pass the status check
     result = await db.execute(
-        select(Upload).where(
-            Upload.id == request.upload_id,
-            Upload.user_id == current_user.id
-        )
+        CLAIM_UPLOAD_STMT, {"upload_id": request.upload_id, "owner_id": current_user.id}
     )
     upload = result.scalar_one_or_none()
     
     if not upload:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload not found")
-    
-    if upload.status == "processing":
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="File is already being processed"
+        # Nothing claimed: find out why
+        status_result = await db.execute(
+            UPLOAD_STATUS_STMT, {"upload_id": request.upload_id, "user_id": current_user.id}
         )
-    
-    if upload.status == "completed":
+        upload_status = status_result.scalar_one_or_none()
+        
+        if upload_status is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload not found")
+        
+        if upload_status == "processing":
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="File is already being processed"
+            )
+        
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="File has already been processed"
         )
     
-    # Update status to processing
-    await db.execute(
-        update(Upload)
-        .where(Upload.id == request.upload_id)
-        .values(status="processing", error_message=None)
-    )
-    await db.commit()
-    
-    # CONSUME CREDITS BEFORE PROCESSING
+    # CONSUME CREDITS BEFORE PROCESSING, in the same transaction as the claim
     try:
-        from app.api.credits import get_credit_cost, consume_credits
-        
         # Get the credit cost for file processing
         credit_cost = await get_credit_cost("file_processing", db)
         
@@ -148,90 +245,29 @@ async def process_file(
                 "filename": upload.original_filename,
                 "file_size": upload.file_size
             },
-            db=db
+            db=db,
+            commit=False
         )
+        await db.commit()
     except HTTPException as e:
-        # Revert status if credit deduction fails
+        # Undo the claim and record why
+        await db.rollback()
         await db.execute(
-            update(Upload)
-            .where(Upload.id == request.upload_id)
-            .values(status="pending", error_message=str(e.detail))
+            SET_UPLOAD_STATUS_STMT,
+            {"upload_id": request.upload_id, "new_status": "pending", "new_error_message": str(e.detail)}
         )
         await db.commit()
         raise e
     
-    try:
-        # Step 1: Extract text from file (REAL PROCESSING)
-        file_processor = FileProcessor()
-        text_content = await file_processor.extract_text_from_file(
-            upload.file_path,
-            upload.mime_type or "text/plain"
-        )
-        
-        if not text_content or len(text_content.strip()) < 10:
-            raise ValueError("File appears to be empty or contains insufficient text")
-        
-        # Step 2: Perform document analysis (REAL ANALYSIS)
-        # Offload CPU-intensive analysis to thread pool
-        document_analysis = await run_in_threadpool(
-            file_processor.analyze_document,
-            text_content
-        )
-        
-        # Step 3: Get AI insights from Hugging Face (REAL AI)
-        ai_analysis = await hf_service.analyze_text(
-            text_content[:1000],  # First 1000 chars for AI
-            # request.model_name
-        )
-        
-        # Combine results
-        combined_result = {
-            **ai_analysis,
-            "document_metrics": document_analysis,
-            "text_preview": text_content[:500],
-            "total_characters": len(text_content)
-        }
-        
-        # Step 4: Save result to database - STORE FULL TEXT CONTENT
-        audit_result = AuditResult(
-            user_id=current_user.id,
-            upload_id=upload.id,
-            input_text=text_content,  # Store full text, not truncated
-            result_json=combined_result,
-            status="completed"
-        )
-        db.add(audit_result)
-        
-        # Step 5: Update upload status
-        await db.execute(
-            update(Upload)
-            .where(Upload.id == request.upload_id)
-            .values(status="completed", error_message=None)
-        )
-        
-        await db.commit()
-        await db.refresh(audit_result)
-        
-        return FileProcessingResponse(
-            upload_id=upload.id,
-            status="completed",
-            message="File processed successfully",
-            result_id=audit_result.id
-        )
-        
-    except Exception as e:
-        # Mark as failed with error message
-        await db.execute(
-            update(Upload)
-            .where(Upload.id == request.upload_id)
-            .values(status="failed", error_message=str(e))
-        )
-        await db.commit()
-        
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Processing failed: {str(e)}"
-        )
+    # Extraction and analysis run in the background; poll
+    # GET /api/uploads/{upload_id} for the outcome
+    submit_file_processing(upload.id, current_user.id)
+    
+    return FileProcessingResponse(
+        upload_id=upload.id,
+        status="processing",
+        message="File processing started"
+    )
 
 
 @router.get("/{upload_id}", response_model=UploadWithStatusResponse)
@@ -241,15 +277,11 @@ async def get_upload_by_id(
     db: AsyncSession = Depends(get_db)
 ):
     """Get specific upload details"""
-    result = await db.execute(
-        select(Upload).where(
-            Upload.id == upload_id,
-            Upload.user_id == current_user.id
-        )
-    )
-    upload = result.scalar_one_or_none()
+    # Primary-key lookup (served from the identity map when already loaded);
+    # another user's upload is reported as not found
+    upload = await db.get(Upload, upload_id)
     
-    if not upload:
+    if not upload or upload.user_id != current_user.id:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload not found")
     
     return upload
@@ -262,21 +294,17 @@ async def delete_upload(
     db: AsyncSession = Depends(get_db)
 ):
     """Delete an uploaded file"""
-    result = await db.execute(
-        select(Upload).where(
-            Upload.id == upload_id,
-            Upload.user_id == current_user.id
-        )
-    )
-    upload = result.scalar_one_or_none()
+    # Primary-key lookup (served from the identity map when already loaded);
+    # another user's upload is reported as not found
+    upload = await db.get(Upload, upload_id)
     
-    if not upload:
+    if not upload or upload.user_id != current_user.id:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload not found")
     
     # Delete file from filesystem
     try:
-        if upload.file_path and os.path.exists(upload.file_path):
-            os.remove(upload.file_path)
+        if upload.file_path and await aiofiles.os.path.exists(upload.file_path):
+            await aiofiles.os.remove(upload.file_path)
     except Exception as e:
         print(f"Warning: Could not delete file: {e}")
     
@@ -1,4 +1,5 @@
 from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.ext.asyncio import AsyncSession
 from app.db import get_db
 from app.models import User
@@ -24,7 +25,7 @@ async def update_profile(
         current_user.email = user_update.email
     
     if user_update.password is not None:
-        current_user.hashed_password = get_password_hash(user_update.password)
+        current_user.hashed_password = await run_in_threadpool(get_password_hash, user_update.password)
     
     await db.commit()
     await db.refresh(current_user)
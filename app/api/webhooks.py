@@ -1,17 +1,27 @@
 from fastapi import APIRouter, Request, HTTPException, Depends
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, update, func
+from sqlalchemy.orm import joinedload
 from datetime import datetime
+import logging
 
 from ..db import get_db
 from .. import models
 from ..services import stripe_service
+from ..middleware.subscription import invalidate_plan_limits, get_free_plan
+from ..cache import get_redis
 
 router = APIRouter(
     prefix="/webhooks",
     tags=["Webhooks"]
 )
 
+# Processed event ids are remembered for longer than Stripe keeps retrying
+STRIPE_EVENT_KEY_PREFIX = "stripe:evt:"
+STRIPE_EVENT_TTL = 86400  # seconds
+
+logger = logging.getLogger(__name__)
+
 @router.post("/stripe")
 async def stripe_webhook(
     request: Request,
@@ -19,6 +29,7 @@ async def stripe_webhook(
 ):
     """
     Handle Stripe webhook events
+    A failed handler returns an error so Stripe retries the event
     """
     # Get the request body and signature header
     payload = await request.body()
@@ -33,32 +44,42 @@ async def stripe_webhook(
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
     
-    # Handle different event types
-    event_type = event["type"]
-    
-    if event_type == "checkout.session.completed":
-        await handle_checkout_completed(event["data"]["object"], db)
-    
-    elif event_type == "customer.subscription.created":
-        await handle_subscription_created(event["data"]["object"], db)
-    
-    elif event_type == "customer.subscription.updated":
-        await handle_subscription_updated(event["data"]["object"], db)
-    
-    elif event_type == "customer.subscription.deleted":
-        await handle_subscription_deleted(event["data"]["object"], db)
-    
-    elif event_type == "invoice.payment_succeeded":
-        await handle_payment_succeeded(event["data"]["object"], db)
-    
-    elif event_type == "invoice.payment_failed":
-        await handle_payment_failed(event["data"]["object"], db)
-    
-    elif event_type == "payment_intent.succeeded":
-        await handle_payment_intent_succeeded(event["data"]["object"], db)
+    # Stripe delivers events at least once; only the first delivery of an
+    # event id is processed
+    event_key = f"{STRIPE_EVENT_KEY_PREFIX}{event['id']}"
+    try:
+        redis_client = await get_redis()
+        if not await redis_client.set(event_key, 1, nx=True, ex=STRIPE_EVENT_TTL):
+            return {"status": "duplicate"}
+    except Exception:
+        # Redis unavailable - process without deduplication
+        redis_client = None
+    
+    # Handled inline: the handlers are a few single-statement writes, and
+    # acknowledging only after they commit means no event is lost
+    try:
+        await handle_event(event, db)
+    except Exception:
+        await db.rollback()
+        logger.exception("Failed to process Stripe event %s (%s)", event["id"], event["type"])
+        # Let Stripe's retry of this event be processed
+        if redis_client:
+            try:
+                await redis_client.delete(event_key)
+            except Exception:
+                pass
+        raise
     
     return {"status": "success"}
 
+async def handle_event(event, db: AsyncSession):
+    """
+    Dispatch a verified Stripe event to its handler
+    """
+    handler = EVENT_HANDLERS.get(event["type"])
+    if handler:
+        await handler(event["data"]["object"], db)
+
 async def handle_checkout_completed(session, db: AsyncSession):
     """
     Handle successful checkout session completion
@@ -67,23 +88,19 @@ async def handle_checkout_completed(session, db: AsyncSession):
     plan_name = session["metadata"].get("plan_name")
     billing_cycle = session["metadata"].get("billing_cycle")
     
-    # Get user's subscription
+    # Get user's subscription and the purchased plan in one round-trip
     result = await db.execute(
-        select(models.Subscription).where(models.Subscription.user_id == user_id)
+        select(models.Subscription, models.Plan)
+        .join(models.Plan, models.Plan.name == plan_name)
+        .where(models.Subscription.user_id == user_id)
     )
-    subscription = result.scalar_one_or_none()
+    row = result.first()
     
-    if not subscription:
+    # Either the subscription or the plan is missing
+    if not row:
         return
     
-    # Get the plan
-    plan_result = await db.execute(
-        select(models.Plan).where(models.Plan.name == plan_name)
-    )
-    plan = plan_result.scalar_one_or_none()
-    
-    if not plan:
-        return
+    subscription, plan = row
     
     # Update subscription
     subscription.plan_id = plan.id
@@ -105,6 +122,7 @@ async def handle_checkout_completed(session, db: AsyncSession):
     db.add(transaction)
     
     await db.commit()
+    await invalidate_plan_limits(user_id)
 
 async def handle_subscription_created(subscription_data, db: AsyncSession):
     """
@@ -113,18 +131,18 @@ async def handle_subscription_created(subscription_data, db: AsyncSession):
     customer_id = subscription_data["customer"]
     subscription_id = subscription_data["id"]
     
-    # Find subscription by Stripe customer ID
-    result = await db.execute(
-        select(models.Subscription).where(models.Subscription.stripe_customer_id == customer_id)
+    # Update the subscription with this Stripe customer ID in one statement
+    await db.execute(
+        update(models.Subscription)
+        .where(models.Subscription.stripe_customer_id == customer_id)
+        .values(
+            stripe_subscription_id=subscription_id,
+            status="active",
+            current_period_start=datetime.fromtimestamp(subscription_data["current_period_start"]),
+            current_period_end=datetime.fromtimestamp(subscription_data["current_period_end"])
+        )
     )
-    subscription = result.scalar_one_or_none()
-    
-    if subscription:
-        subscription.stripe_subscription_id = subscription_id
-        subscription.status = "active"
-        subscription.current_period_start = datetime.fromtimestamp(subscription_data["current_period_start"])
-        subscription.current_period_end = datetime.fromtimestamp(subscription_data["current_period_end"])
-        await db.commit()
+    await db.commit()
 
 async def handle_subscription_updated(subscription_data, db: AsyncSession):
     """
@@ -132,27 +150,24 @@ async def handle_subscription_updated(subscription_data, db: AsyncSession):
     """
     subscription_id = subscription_data["id"]
     
-    # Find subscription by Stripe subscription ID
-    result = await db.execute(
-        select(models.Subscription).where(models.Subscription.stripe_subscription_id == subscription_id)
-    )
-    subscription = result.scalar_one_or_none()
-    
-    if not subscription:
-        return
-    
-    # Update period dates
-    subscription.current_period_start = datetime.fromtimestamp(subscription_data["current_period_start"])
-    subscription.current_period_end = datetime.fromtimestamp(subscription_data["current_period_end"])
-    
-    # Update status
-    subscription.status = subscription_data["status"]
+    # Update period dates and status
+    values = {
+        "current_period_start": datetime.fromtimestamp(subscription_data["current_period_start"]),
+        "current_period_end": datetime.fromtimestamp(subscription_data["current_period_end"]),
+        "status": subscription_data["status"]
+    }
     
     # If subscription is canceled
     if subscription_data.get("cancel_at_period_end"):
-        subscription.status = "cancelled"
-        subscription.cancelled_at = datetime.utcnow()
-    
+        values["status"] = "cancelled"
+        values["cancelled_at"] = func.now()
+    
+    # Update the subscription with this Stripe subscription ID in one statement
+    await db.execute(
+        update(models.Subscription)
+        .where(models.Subscription.stripe_subscription_id == subscription_id)
+        .values(**values)
+    )
     await db.commit()
 
 async def handle_subscription_deleted(subscription_data, db: AsyncSession):
@@ -171,10 +186,9 @@ async def handle_subscription_deleted(subscription_data, db: AsyncSession):
         return
     
     # Get free plan
-    free_plan_result = await db.execute(
-        select(models.Plan).where(models.Plan.name == "free")
-    )
-    free_plan = free_plan_result.scalar_one()
+    free_plan = await get_free_plan(db)
+    if not free_plan:
+        raise HTTPException(status_code=500, detail="Free plan not initialized")
     
     # Downgrade to free
     subscription.plan_id = free_plan.id
@@ -182,9 +196,10 @@ async def handle_subscription_deleted(subscription_data, db: AsyncSession):
     subscription.billing_cycle = None
     subscription.stripe_subscription_id = None
     subscription.credits_remaining = free_plan.credits_per_month
-    subscription.cancelled_at = datetime.utcnow()
+    subscription.cancelled_at = func.now()  # set by the database in the UPDATE
     
     await db.commit()
+    await invalidate_plan_limits(subscription.user_id)
 
 async def handle_payment_succeeded(invoice, db: AsyncSession):
     """
@@ -196,20 +211,19 @@ async def handle_payment_succeeded(invoice, db: AsyncSession):
     if not subscription_id:
         return
     
-    # Find subscription
+    # Find subscription with its plan relationship loaded in the same query,
+    # so subscription.plan never lazy-loads
     result = await db.execute(
-        select(models.Subscription).where(models.Subscription.stripe_subscription_id == subscription_id)
+        select(models.Subscription)
+        .options(joinedload(models.Subscription.plan))
+        .where(models.Subscription.stripe_subscription_id == subscription_id)
     )
     subscription = result.scalar_one_or_none()
     
     if not subscription:
         return
     
-    # Get plan
-    plan_result = await db.execute(
-        select(models.Plan).where(models.Plan.id == subscription.plan_id)
-    )
-    plan = plan_result.scalar_one()
+    plan = subscription.plan
     
     # Refresh credits for new period
     # Handle rollover
@@ -241,15 +255,13 @@ async def handle_payment_failed(invoice, db: AsyncSession):
     if not subscription_id:
         return
     
-    # Find subscription
-    result = await db.execute(
-        select(models.Subscription).where(models.Subscription.stripe_subscription_id == subscription_id)
+    # Mark the subscription past due in one statement
+    await db.execute(
+        update(models.Subscription)
+        .where(models.Subscription.stripe_subscription_id == subscription_id)
+        .values(status="past_due")
     )
-    subscription = result.scalar_one_or_none()
-    
-    if subscription:
-        subscription.status = "past_due"
-        await db.commit()
+    await db.commit()
     
     # TODO: Send email notification to user
 
@@ -283,3 +295,14 @@ async def handle_payment_intent_succeeded(payment_intent, db: AsyncSession):
             db.add(transaction)
             
             await db.commit()
+
+# Handler for each Stripe event type; other event types are ignored
+EVENT_HANDLERS = {
+    "checkout.session.completed": handle_checkout_completed,
+    "customer.subscription.created": handle_subscription_created,
+    "customer.subscription.updated": handle_subscription_updated,
+    "customer.subscription.deleted": handle_subscription_deleted,
+    "invoice.payment_succeeded": handle_payment_succeeded,
+    "invoice.payment_failed": handle_payment_failed,
+    "payment_intent.succeeded": handle_payment_intent_succeeded,
+}
@@ -1,33 +1,141 @@
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect
-from typing import List, Dict
+from typing import Dict, Optional, Set
+import asyncio
+import logging
+import uuid
+import redis.asyncio as redis
+from app.config import settings
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(
     prefix="/ws",
     tags=["websockets"]
 )
 
+# A peer that cannot take an update within this time is disconnected
+SEND_TIMEOUT = 2.0  # seconds
+
+# Updates are relayed between workers over Redis pub/sub on ws:doc:{doc_id};
+# each message is prefixed with the publishing worker's id so it can skip
+# its own messages
+RELAY_CHANNEL_PREFIX = "ws:doc:"
+RELAY_RETRY_INTERVAL = 5.0  # seconds
+WORKER_ID = uuid.uuid4().hex.encode()
+
 class ConnectionManager:
     def __init__(self):
-        # Map document_id to list of WebSockets
-        self.active_connections: Dict[int, List[WebSocket]] = {}
+        # Map document_id to the set of connected WebSockets
+        self.active_connections: Dict[int, Set[WebSocket]] = {}
+        # Binary-safe client for the relay (the shared client decodes to str)
+        self._redis: Optional[redis.Redis] = None
+        self._relay: Optional[asyncio.Task] = None
+        # Only publish while subscribed, so a Redis outage costs nothing per message
+        self._relay_connected = False
+        # Strong references to relayed broadcasts so they are not garbage collected
+        self._relay_broadcasts: Set[asyncio.Task] = set()
 
     async def connect(self, websocket: WebSocket, doc_id: int):
         await websocket.accept()
         if doc_id not in self.active_connections:
-            self.active_connections[doc_id] = []
-        self.active_connections[doc_id].append(websocket)
+            self.active_connections[doc_id] = set()
+        self.active_connections[doc_id].add(websocket)
 
     def disconnect(self, websocket: WebSocket, doc_id: int):
         if doc_id in self.active_connections:
-            self.active_connections[doc_id].remove(websocket)
+            self.active_connections[doc_id].discard(websocket)
             if not self.active_connections[doc_id]:
                 del self.active_connections[doc_id]
 
     async def broadcast(self, message: bytes, doc_id: int, sender: WebSocket):
         if doc_id in self.active_connections:
-            for connection in self.active_connections[doc_id]:
-                if connection != sender:
-                    await connection.send_bytes(message)
+            peers = [
+                connection for connection in self.active_connections[doc_id]
+                if connection is not sender
+            ]
+            # Send to all peers concurrently; a slow or broken peer must not
+            # hold up the sender or the other peers
+            results = await asyncio.gather(
+                *(
+                    asyncio.wait_for(connection.send_bytes(message), timeout=SEND_TIMEOUT)
+                    for connection in peers
+                ),
+                return_exceptions=True
+            )
+            # Peers that missed an update are out of sync; drop them so
+            # their clients reconnect and resync
+            failed = [
+                connection for connection, result in zip(peers, results)
+                if isinstance(result, BaseException)
+            ]
+            for connection in failed:
+                self.disconnect(connection, doc_id)
+            await asyncio.gather(
+                *(
+                    asyncio.wait_for(connection.close(code=1011), timeout=SEND_TIMEOUT)
+                    for connection in failed
+                ),
+                return_exceptions=True
+            )
+
+    async def publish(self, message: bytes, doc_id: int, sender: WebSocket):
+        """Deliver an update to local peers and relay it to other workers"""
+        await self.broadcast(message, doc_id, sender)
+        if not self._relay_connected:
+            return
+        try:
+            await self._redis.publish(f"{RELAY_CHANNEL_PREFIX}{doc_id}", WORKER_ID + message)
+        except Exception as e:
+            logger.warning("WebSocket relay publish failed: %s", e)
+
+    def start_relay(self):
+        """Start forwarding other workers' updates to local sockets"""
+        if self._relay is None:
+            self._redis = redis.from_url(settings.REDIS_URL)
+            self._relay = asyncio.create_task(self._run_relay())
+
+    async def close(self):
+        """Stop the relay and let relayed broadcasts finish"""
+        if self._relay is not None:
+            self._relay.cancel()
+            try:
+                await self._relay
+            except asyncio.CancelledError:
+                pass
+            self._relay = None
+        if self._relay_broadcasts:
+            await asyncio.gather(*self._relay_broadcasts, return_exceptions=True)
+        if self._redis is not None:
+            await self._redis.close()
+            self._redis = None
+
+    async def _run_relay(self):
+        while True:
+            try:
+                async with self._redis.pubsub(ignore_subscribe_messages=True) as pubsub:
+                    await pubsub.psubscribe(f"{RELAY_CHANNEL_PREFIX}*")
+                    self._relay_connected = True
+                    async for message in pubsub.listen():
+                        data = message["data"]
+                        if data.startswith(WORKER_ID):
+                            continue
+                        doc_id = int(message["channel"][len(RELAY_CHANNEL_PREFIX):])
+                        # Fan out in the background so a slow peer in one
+                        # room never holds up the relay for other documents
+                        task = asyncio.create_task(
+                            self.broadcast(data[len(WORKER_ID):], doc_id, None)
+                        )
+                        self._relay_broadcasts.add(task)
+                        task.add_done_callback(self._relay_broadcasts.discard)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Redis unavailable - keep serving local peers and retry
+                if self._relay_connected:
+                    logger.warning("WebSocket relay disconnected: %s", e)
+                await asyncio.sleep(RELAY_RETRY_INTERVAL)
+            finally:
+                self._relay_connected = False
 
 manager = ConnectionManager()
 
@@ -37,7 +145,8 @@ async def websocket_endpoint(websocket: WebSocket, doc_id: int):
     try:
         while True:
             data = await websocket.receive_bytes()
-            # Broadcast the received data (e.g., Yjs updates) to other clients
-            await manager.broadcast(data, doc_id, websocket)
+            # Broadcast the received data (e.g., Yjs updates) to other clients,
+            # including those connected to other workers
+            await manager.publish(data, doc_id, websocket)
     except WebSocketDisconnect:
         manager.disconnect(websocket, doc_id)
@@ -1,4 +1,5 @@
 # Cache module initialization
-from .redis_cache import Cache, get_redis, close_redis, cache_result, invalidate_cache
+from .redis_cache import Cache, get_cache, get_redis, close_redis, cache_result, invalidate_cache
+from .idempotency import IdempotentRequest, idempotent_request
 
-__all__ = ['Cache', 'get_redis', 'close_redis', 'cache_result', 'invalidate_cache']
+__all__ = ['Cache', 'get_cache', 'get_redis', 'close_redis', 'cache_result', 'invalidate_cache', 'IdempotentRequest', 'idempotent_request']
@@ -0,0 +1,116 @@
+"""
+Idempotency keys for non-idempotent POST endpoints.
+
+The first request for a key reserves it in Redis; its response is stored
+under the same key so retries get the original response back instead of
+repeating the side effects.
+"""
+
+from typing import Any, Optional
+import hashlib
+import orjson
+from fastapi import HTTPException, status
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel
+
+from .redis_cache import get_redis
+
+
+# How long a completed response is replayed for
+IDEMPOTENCY_TTL = 300  # seconds
+# Placeholder stored while the first request is still running
+_IN_PROGRESS = "__in_progress__"
+
+
+class IdempotentRequest:
+    """Reservation of an idempotency key for one request."""
+
+    def __init__(self, key: Optional[str] = None, cached: Any = None):
+        self.key = key
+        # Response of an earlier request with the same key, if any
+        self.cached = cached
+
+    async def finish(self, response: Any) -> None:
+        """
+        Store the response for replay.
+
+        Args:
+            response: Response returned by the endpoint
+        """
+        if not self.key:
+            return
+        try:
+            redis_client = await get_redis()
+            await redis_client.set(
+                self.key,
+                orjson.dumps(jsonable_encoder(response)).decode(),
+                ex=IDEMPOTENCY_TTL
+            )
+        except Exception:
+            pass
+
+    async def fail(self) -> None:
+        """Release the key so the request can be retried."""
+        if not self.key:
+            return
+        try:
+            redis_client = await get_redis()
+            await redis_client.delete(self.key)
+        except Exception:
+            pass
+
+
+async def idempotent_request(
+    user_id: int,
+    endpoint: str,
+    idempotency_key: Optional[str],
+    payload: Optional[BaseModel] = None
+) -> IdempotentRequest:
+    """
+    Reserve the idempotency key for a request.
+
+    The key is the client's Idempotency-Key header or, without one, a hash
+    of the request body. Pass no payload to only dedupe requests that carry
+    the header.
+
+    Args:
+        user_id: Requesting user
+        endpoint: Name of the endpoint the key is scoped to
+        idempotency_key: Idempotency-Key header value
+        payload: Request body
+
+    Returns:
+        Reservation; its ``cached`` attribute holds the earlier response
+        when the request is a replay
+
+    Raises:
+        HTTPException: If a request with the same key is still running
+    """
+    if idempotency_key:
+        fingerprint = idempotency_key
+    elif payload is not None:
+        fingerprint = payload.model_dump_json()
+    else:
+        return IdempotentRequest()
+
+    digest = hashlib.sha256(fingerprint.encode()).hexdigest()
+    key = f"idem:{user_id}:{endpoint}:{digest}"
+
+    try:
+        redis_client = await get_redis()
+        if await redis_client.set(key, _IN_PROGRESS, nx=True, ex=IDEMPOTENCY_TTL):
+            return IdempotentRequest(key)
+        stored = await redis_client.get(key)
+    except Exception:
+        # Redis unavailable - process the request without deduplication
+        return IdempotentRequest()
+
+    if stored is None:
+        # Expired between SET and GET; treat as a new request
+        return IdempotentRequest()
+    if stored == _IN_PROGRESS:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="A request with this idempotency key is already in progress"
+        )
+    return IdempotentRequest(cached=orjson.loads(stored))
@@ -7,13 +7,24 @@ to improve application performance.
 
 from typing import Optional, Any, Callable
 from functools import wraps
-import json
+import asyncio
+import orjson
 import redis.asyncio as redis
 from app.config import settings
 
 
+# Keys examined per SCAN call and removed per UNLINK in delete_pattern
+SCAN_COUNT = 1000
+UNLINK_BATCH_SIZE = 512
+
+# While one caller recomputes a missing cache_result entry, others wait for it
+CACHE_LOCK_TTL = 10  # seconds
+CACHE_LOCK_POLL_INTERVAL = 0.05  # seconds
+
 # Redis client instance
 redis_client: Optional[redis.Redis] = None
+# Shared Cache wrapper around redis_client
+_cache: Optional["Cache"] = None
 
 
 async def get_redis() -> redis.Redis:
@@ -35,10 +46,11 @@ async def get_redis() -> redis.Redis:
 
 async def close_redis() -> None:
     """Close Redis connection."""
-    global redis_client
+    global redis_client, _cache
     if redis_client:
         await redis_client.close()
         redis_client = None
+    _cache = None
 
 
 class Cache:
@@ -60,8 +72,8 @@ class Cache:
         value = await self.redis.get(key)
         if value:
             try:
-                return json.loads(value)
-            except json.JSONDecodeError:
+                return orjson.loads(value)
+            except orjson.JSONDecodeError:
                 return value
         return None
     
@@ -83,7 +95,7 @@ class Cache:
             True if successful
         """
         try:
-            serialized = json.dumps(value) if not isinstance(value, str) else value
+            serialized = orjson.dumps(value).decode() if not isinstance(value, str) else value
             return await self.redis.setex(key, ttl, serialized)
         except (TypeError, ValueError):
             return False
@@ -110,13 +122,17 @@ class Cache:
         Returns:
             Number of keys deleted
         """
-        keys = []
-        async for key in self.redis.scan_iter(match=pattern):
-            keys.append(key)
+        deleted = 0
+        batch = []
+        async for key in self.redis.scan_iter(match=pattern, count=SCAN_COUNT):
+            batch.append(key)
+            if len(batch) >= UNLINK_BATCH_SIZE:
+                deleted += await self.redis.unlink(*batch)
+                batch = []
         
-        if keys:
-            return await self.redis.delete(*keys)
-        return 0
+        if batch:
+            deleted += await self.redis.unlink(*batch)
+        return deleted
     
     async def exists(self, key: str) -> bool:
         """
@@ -131,6 +147,19 @@ class Cache:
         return await self.redis.exists(key) > 0
 
 
+async def get_cache() -> Cache:
+    """
+    Get the shared Cache instance.
+    
+    Returns:
+        Cache bound to the Redis client
+    """
+    global _cache
+    if _cache is None:
+        _cache = Cache(await get_redis())
+    return _cache
+
+
 def cache_result(
     key_prefix: str,
     ttl: int = 3600,
@@ -161,16 +190,33 @@ def cache_result(
                 cache_key = f"{key_prefix}:{args[0]}" if args else key_prefix
             
             # Try to get from cache
-            redis_instance = await get_redis()
-            cache = Cache(redis_instance)
+            cache = await get_cache()
+            redis_instance = cache.redis
             cached_value = await cache.get(cache_key)
             
             if cached_value is not None:
                 return cached_value
             
+            # Only one caller recomputes a missing entry; the others poll
+            # for its result until the lock expires
+            lock_key = f"{cache_key}:lock"
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + CACHE_LOCK_TTL
+            locked = await redis_instance.set(lock_key, "1", nx=True, ex=CACHE_LOCK_TTL)
+            while not locked and loop.time() < deadline:
+                await asyncio.sleep(CACHE_LOCK_POLL_INTERVAL)
+                cached_value = await cache.get(cache_key)
+                if cached_value is not None:
+                    return cached_value
+                locked = await redis_instance.set(lock_key, "1", nx=True, ex=CACHE_LOCK_TTL)
+            
             # Execute function and cache result
-            result = await func(*args, **kwargs)
-            await cache.set(cache_key, result, ttl)
+            try:
+                result = await func(*args, **kwargs)
+                await cache.set(cache_key, result, ttl)
+            finally:
+                if locked:
+                    await redis_instance.delete(lock_key)
             
             return result
         
@@ -188,6 +234,5 @@ async def invalidate_cache(pattern: str) -> int:
     Returns:
         Number of keys invalidated
     """
-    redis_instance = await get_redis()
-    cache = Cache(redis_instance)
+    cache = await get_cache()
     return await cache.delete_pattern(pattern)
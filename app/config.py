@@ -1,4 +1,5 @@
 from pydantic_settings import BaseSettings
+from functools import cached_property
 from typing import List
 
 class Settings(BaseSettings):
@@ -12,15 +13,23 @@ class Settings(BaseSettings):
     REDIS_URL: str = "redis://localhost:6379/0"
     MAX_FILE_SIZE: int = 10485760  # 10MB
     UPLOAD_DIR: str = "uploads"
+    # Per-process connection pool; keep (DB_POOL_SIZE + DB_MAX_OVERFLOW) *
+    # worker count below Postgres max_connections
+    DB_POOL_SIZE: int = 20
+    DB_MAX_OVERFLOW: int = 40
+    DB_POOL_RECYCLE: int = 1800  # seconds
+    DB_POOL_TIMEOUT: int = 5  # seconds to wait for a free connection
     HF_BASE_URL: str
     HF_MODEL_NAME: str
+    DEBUG: bool = False  # Enables SQL statement logging
     
     # Stripe
     STRIPE_SECRET_KEY: str
     STRIPE_PUBLISHABLE_KEY: str
     STRIPE_WEBHOOK_SECRET: str
     
-    @property
+    # Settings are not changed after startup, so the split is done once
+    @cached_property
     def origins_list(self) -> List[str]:
         return [origin.strip() for origin in self.ALLOWED_ORIGINS.split(",")]
     
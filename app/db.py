@@ -1,28 +1,49 @@
+import asyncio
+import logging
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from sqlalchemy.orm import declarative_base
 from app.config import settings
 
+# Always use the async driver: a plain postgresql:// URL would select psycopg2
+database_url = settings.DATABASE_URL
+if database_url.startswith("postgresql://"):
+    database_url = database_url.replace("postgresql://", "postgresql+asyncpg://", 1)
+elif database_url.startswith("postgres://"):
+    database_url = database_url.replace("postgres://", "postgresql+asyncpg://", 1)
+
 # Determine if we're using SQLite
-is_sqlite = settings.DATABASE_URL.startswith("sqlite")
+is_sqlite = database_url.startswith("sqlite")
 
 # Configure engine with appropriate settings based on database type
 if is_sqlite:
     # SQLite doesn't support connection pooling
     engine = create_async_engine(
-        settings.DATABASE_URL,
-        echo=False,  # Set to True for SQL query logging in development
+        database_url,
+        echo=settings.DEBUG,  # SQL query logging in development only
         future=True,
     )
 else:
     # PostgreSQL/MySQL with connection pooling
     engine = create_async_engine(
-        settings.DATABASE_URL,
-        echo=False,  # Set to True for SQL query logging in development
+        database_url,
+        echo=settings.DEBUG,  # SQL query logging in development only
         future=True,
-        pool_size=10,  # Maximum number of connections to keep in the pool
-        max_overflow=20,  # Maximum number of connections that can be created beyond pool_size
+        poolclass=AsyncAdaptedQueuePool,  # asyncio-safe queue pool
+        pool_size=settings.DB_POOL_SIZE,  # Maximum number of connections to keep in the pool
+        max_overflow=settings.DB_MAX_OVERFLOW,  # Maximum number of connections that can be created beyond pool_size
         pool_pre_ping=True,  # Verify connections before using them
-        pool_recycle=3600,  # Recycle connections after 1 hour
+        pool_recycle=settings.DB_POOL_RECYCLE,  # Recycle connections before server/proxy idle timeouts
+        pool_timeout=settings.DB_POOL_TIMEOUT,  # Fail fast instead of queueing forever when exhausted
+        connect_args={
+            "prepared_statement_cache_size": 512,  # SQLAlchemy asyncpg adapter cache
+            "statement_cache_size": 1024,  # asyncpg's own prepared statement cache
+            "server_settings": {
+                "jit": "off",  # JIT compilation stalls asyncpg type introspection
+                "application_name": "scanpilot",
+            },
+            "command_timeout": 30,  # seconds per statement
+        } if database_url.startswith("postgresql+asyncpg") else {},
     )
 
 async_session_maker = async_sessionmaker(
@@ -35,6 +56,8 @@ async_session_maker = async_sessionmaker(
 
 Base = declarative_base()
 
+logger = logging.getLogger(__name__)
+
 
 async def get_db() -> AsyncSession:
     """
@@ -53,7 +76,88 @@ async def get_db() -> AsyncSession:
             await session.close()
 
 
+_METADATA_JSONB_SQL = """
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'credit_transactions'
+          AND column_name = 'metadata_json'
+          AND data_type = 'json'
+    ) THEN
+        ALTER TABLE credit_transactions
+            ALTER COLUMN metadata_json TYPE jsonb USING metadata_json::jsonb;
+    END IF;
+END $$
+"""
+
+# Uppercase referral codes stored before codes were canonical, then enforce
+# it; a case-only duplicate is reported instead of failing startup
+_REFERRAL_CODE_UPPER_SQL = """
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_constraint WHERE conname = 'ck_referrals_code_upper'
+    ) THEN
+        UPDATE referrals SET referral_code = upper(referral_code)
+            WHERE referral_code <> upper(referral_code);
+        ALTER TABLE referrals
+            ADD CONSTRAINT ck_referrals_code_upper CHECK (referral_code = upper(referral_code));
+    END IF;
+EXCEPTION WHEN unique_violation THEN
+    RAISE WARNING 'ck_referrals_code_upper not added: referral codes differ only in case';
+END $$
+"""
+
+
 async def init_db() -> None:
     """Initialize database tables."""
+    trigram_search = True
+    if engine.dialect.name == "postgresql":
+        # Extensions backing the trigram search indexes. Installing them needs
+        # CREATE on the database; without it the app still starts and the
+        # trigram indexes are skipped
+        try:
+            async with engine.begin() as conn:
+                await conn.exec_driver_sql("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+                await conn.exec_driver_sql("CREATE EXTENSION IF NOT EXISTS btree_gin")
+        except Exception:
+            trigram_search = False
+            logger.warning(
+                "pg_trgm/btree_gin unavailable; skipping the trigram search indexes",
+                exc_info=True
+            )
+    
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
\ No newline at end of file
+        # Read by the trigram indexes' ddl_if condition
+        conn.info["trigram_search"] = trigram_search
+        await conn.run_sync(Base.metadata.create_all)
+        if engine.dialect.name == "postgresql":
+            # create_all does not alter existing tables; convert transaction
+            # metadata created as json to jsonb and add the referral code
+            # check constraint (both no-ops once applied)
+            await conn.exec_driver_sql(_METADATA_JSONB_SQL)
+            await conn.exec_driver_sql(_REFERRAL_CODE_UPPER_SQL)
+    
+    if engine.dialect.name == "postgresql":
+        # create_all only creates indexes along with new tables; add indexes
+        # declared since an existing table was created. Each runs on its own
+        # so one failure (e.g. duplicates blocking a unique index) is reported
+        # without undoing the others
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                try:
+                    async with engine.begin() as conn:
+                        conn.info["trigram_search"] = trigram_search
+                        # Skips existing indexes and honors ddl_if conditions
+                        await conn.run_sync(index.create, checkfirst=True)
+                except Exception as e:
+                    logger.warning("Could not create index %s: %s", index.name, e)
+    
+    if not is_sqlite:
+        # Open the pool's connections up front so the first requests do not
+        # pay for connection setup
+        connections = await asyncio.gather(
+            *(engine.connect() for _ in range(settings.DB_POOL_SIZE))
+        )
+        await asyncio.gather(*(conn.close() for conn in connections))
\ No newline at end of file
@@ -1,14 +1,20 @@
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 from contextlib import asynccontextmanager
 from .config import settings
-from .db import init_db
+from .db import init_db, engine
 from .cache import get_redis, close_redis
+from .services.credit_consumer import credit_consumer
+from .services.analysis_batcher import analysis_batcher
+from .services.processing import start_stale_upload_reaper, close_processing_jobs
+from .services.ai import start_stale_suggestion_reaper, close_suggestion_jobs
 from .middleware.error_handler import ErrorHandlerMiddleware, validation_exception_handler
+from .middleware.compression import CompressionMiddleware
 from .api import auth, users, uploads, results, documents, ws, subscriptions, credits, referrals, admin, webhooks, collaborators, search
 import os
 
@@ -19,10 +25,16 @@ os.makedirs(settings.UPLOAD_DIR, exist_ok=True)
 async def lifespan(app: FastAPI):
     # Startup
     await init_db()
+    # Pick up uploads left in "processing" by a previous run
+    start_stale_upload_reaper()
     # Initialize Redis connection
     try:
         await get_redis()
         print("✅ Redis connection established")
+        # Share WebSocket rooms across workers
+        ws.manager.start_relay()
+        # Rerun AI suggestion jobs lost by a previous run
+        start_stale_suggestion_reaper()
     except Exception as e:
         print(f"⚠️  Redis connection failed: {e}")
         print("   Application will continue without caching")
@@ -30,15 +42,22 @@ async def lifespan(app: FastAPI):
     yield
     
     # Shutdown
+    await ws.manager.close()
+    await close_processing_jobs()
+    await close_suggestion_jobs()
+    await credit_consumer.close()
+    await analysis_batcher.close()
     await close_redis()
     print("✅ Redis connection closed")
+    await engine.dispose()
 
 limiter = Limiter(key_func=get_remote_address)
 app = FastAPI(
     title="ScanPilot API",
     description="Secure, scalable SaaS backend for document analysis",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 app.state.limiter = limiter
@@ -48,6 +67,9 @@ app.add_exception_handler(RequestValidationError, validation_exception_handler)
 # Add error handling middleware
 app.add_middleware(ErrorHandlerMiddleware)
 
+# Gzip responses over 1KB (event streams are left uncompressed)
+app.add_middleware(CompressionMiddleware, minimum_size=1024, compresslevel=5)
+
 # CORS
 app.add_middleware(
     CORSMiddleware,
@@ -91,4 +113,5 @@ async def health_check():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("app.main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    # Development entry point; production runs the Dockerfile command
+    uvicorn.run("app.main:app", host="0.0.0.0", port=8000, reload=True, loop="uvloop", http="httptools")
\ No newline at end of file
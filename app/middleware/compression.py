@@ -0,0 +1,38 @@
+"""
+Response compression middleware.
+
+Starlette's GZipMiddleware with Server-Sent Events left uncompressed: the
+gzip stream buffers small writes, which would hold events back from the
+client until enough data has accumulated.
+"""
+
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipMiddleware, GZipResponder
+from starlette.types import Message, Receive, Scope, Send
+
+
+class _GZipResponder(GZipResponder):
+    """GZipResponder that passes event streams through untouched."""
+
+    async def send_with_gzip(self, message: Message) -> None:
+        await super().send_with_gzip(message)
+        if message["type"] == "http.response.start":
+            content_type = Headers(raw=message["headers"]).get("content-type", "")
+            if content_type.startswith("text/event-stream"):
+                # Treated like an already-encoded response: sent as is
+                self.content_encoding_set = True
+
+
+class CompressionMiddleware(GZipMiddleware):
+    """Gzip responses for clients that accept it, except event streams."""
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http":
+            headers = Headers(scope=scope)
+            if "gzip" in headers.get("Accept-Encoding", ""):
+                responder = _GZipResponder(
+                    self.app, self.minimum_size, compresslevel=self.compresslevel
+                )
+                await responder(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
@@ -8,7 +8,7 @@ and logging.
 import logging
 from typing import Callable
 from fastapi import Request, Response, status
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 from fastapi.exceptions import RequestValidationError
 from sqlalchemy.exc import SQLAlchemyError
 from starlette.middleware.base import BaseHTTPMiddleware
@@ -45,7 +45,7 @@ class ErrorHandlerMiddleware(BaseHTTPMiddleware):
                     "method": request.method
                 }
             )
-            return JSONResponse(
+            return ORJSONResponse(
                 status_code=exc.status_code,
                 content={"detail": exc.detail}
             )
@@ -59,7 +59,7 @@ class ErrorHandlerMiddleware(BaseHTTPMiddleware):
                 },
                 exc_info=True
             )
-            return JSONResponse(
+            return ORJSONResponse(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 content={"detail": "Database error occurred"}
             )
@@ -73,7 +73,7 @@ class ErrorHandlerMiddleware(BaseHTTPMiddleware):
                 },
                 exc_info=True
             )
-            return JSONResponse(
+            return ORJSONResponse(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 content={"detail": "Internal server error"}
             )
@@ -82,7 +82,7 @@ class ErrorHandlerMiddleware(BaseHTTPMiddleware):
 async def validation_exception_handler(
     request: Request,
     exc: RequestValidationError
-) -> JSONResponse:
+) -> ORJSONResponse:
     """
     Handle validation errors.
     
@@ -100,7 +100,7 @@ async def validation_exception_handler(
             "method": request.method
         }
     )
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
         content={
             "detail": "Validation error",
@@ -2,21 +2,51 @@
 Subscription middleware and decorators for enforcing plan limits
 """
 from functools import wraps
+import asyncio
 from fastapi import HTTPException, Depends
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
-from typing import Callable, Optional
+from sqlalchemy import select, update, func
+from sqlalchemy.orm import joinedload
+from typing import Any, Callable, Dict, Optional, Tuple
 
-from ..db import get_db
+from ..db import get_db, async_session_maker
 from .. import models
 from ..auth import get_current_user
+from ..services.credit_consumer import credit_consumer
+from ..cache import get_cache, get_redis
+
+# Rank of each plan; unknown plans rank as free
+PLAN_HIERARCHY = {"free": 0, "pro": 1, "team": 2, "enterprise": 3}
+
+async def get_user_plan(
+    user_id: int,
+    db: AsyncSession
+) -> Optional[Tuple[models.Subscription, models.Plan]]:
+    """
+    Get a user's subscription and plan
+    Remembered on the session, so decorators stacked on one request share a
+    single query; returns None if the user has no subscription
+    """
+    cached = db.info.setdefault("user_plans", {})
+    if user_id not in cached:
+        # The plan relationship is loaded in the same query, so
+        # subscription.plan is available without lazy loading
+        result = await db.execute(
+            select(models.Subscription)
+            .options(joinedload(models.Subscription.plan))
+            .where(models.Subscription.user_id == user_id)
+        )
+        subscription = result.scalar_one_or_none()
+        cached[user_id] = (subscription, subscription.plan) if subscription else None
+    return cached[user_id]
 
 def require_plan(min_plan: str = "free"):
     """
     Decorator to require minimum subscription plan
     Usage: @require_plan(min_plan="pro")
     """
-    plan_hierarchy = {"free": 0, "pro": 1, "team": 2, "enterprise": 3}
+    # Resolved once when the decorator is applied, not on every request
+    required_level = PLAN_HIERARCHY.get(min_plan, 0)
     
     def decorator(func: Callable):
         @wraps(func)
@@ -29,12 +59,7 @@ def require_plan(min_plan: str = "free"):
                 raise HTTPException(status_code=500, detail="Missing required dependencies")
             
             # Get user's subscription
-            result = await db.execute(
-                select(models.Subscription, models.Plan)
-                .join(models.Plan, models.Subscription.plan_id == models.Plan.id)
-                .where(models.Subscription.user_id == current_user.id)
-            )
-            row = result.first()
+            row = await get_user_plan(current_user.id, db)
             
             if not row:
                 raise HTTPException(
@@ -45,8 +70,7 @@ def require_plan(min_plan: str = "free"):
             subscription, plan = row
             
             # Check if user's plan meets minimum requirement
-            user_plan_level = plan_hierarchy.get(plan.name, 0)
-            required_level = plan_hierarchy.get(min_plan, 0)
+            user_plan_level = PLAN_HIERARCHY.get(plan.name, 0)
             
             if user_plan_level < required_level:
                 raise HTTPException(
@@ -63,9 +87,12 @@ def consume_credits(amount: int, operation_type: str, description: str = None):
     """
     Decorator to automatically consume credits for an operation
     Usage: @consume_credits(amount=2, operation_type="document_analysis")
+    The balance is deducted in the request's transaction; the transaction
+    history row is inserted in batches by credit_consumer
     """
-    def decorator(func: Callable):
-        @wraps(func)
+    # The decorated endpoint is not called func, which would shadow sqlalchemy.func
+    def decorator(endpoint: Callable):
+        @wraps(endpoint)
         async def wrapper(*args, **kwargs):
             db: AsyncSession = kwargs.get("db")
             current_user: models.User = kwargs.get("current_user")
@@ -74,12 +101,7 @@ def consume_credits(amount: int, operation_type: str, description: str = None):
                 raise HTTPException(status_code=500, detail="Missing required dependencies")
             
             # Get user's subscription
-            result = await db.execute(
-                select(models.Subscription, models.Plan)
-                .join(models.Plan, models.Subscription.plan_id == models.Plan.id)
-                .where(models.Subscription.user_id == current_user.id)
-            )
-            row = result.first()
+            row = await get_user_plan(current_user.id, db)
             
             if not row:
                 raise HTTPException(status_code=403, detail="No active subscription")
@@ -89,42 +111,56 @@ def consume_credits(amount: int, operation_type: str, description: str = None):
             # Check if plan has unlimited credits (enterprise)
             if plan.credits_per_month == -1:
                 # Execute function without consuming credits
-                return await func(*args, **kwargs)
+                return await endpoint(*args, **kwargs)
             
-            # Check credit availability
-            total_available = subscription.credits_remaining + subscription.credits_rollover
+            # Deduct credits (prefer rollover first) in one statement; the
+            # balance check is part of the UPDATE, so concurrent requests
+            # cannot overdraw
+            charged = (
+                update(models.Subscription)
+                .where(
+                    models.Subscription.user_id == current_user.id,
+                    models.Subscription.credits_remaining + models.Subscription.credits_rollover >= amount
+                )
+                .values(
+                    credits_rollover=func.greatest(models.Subscription.credits_rollover - amount, 0),
+                    credits_remaining=models.Subscription.credits_remaining
+                    - func.greatest(amount - models.Subscription.credits_rollover, 0)
+                )
+                .returning(models.Subscription.id)
+                .cte("charged")
+            )
+            # The outer SELECT sees the balance the UPDATE was checked against
+            deducted = await db.execute(
+                select(
+                    select(charged.c.id).scalar_subquery().label("subscription_id"),
+                    (models.Subscription.credits_remaining + models.Subscription.credits_rollover).label("available")
+                )
+                .where(models.Subscription.user_id == current_user.id)
+            )
+            subscription_id, total_available = deducted.one()
             
-            if total_available < amount:
+            if subscription_id is None:
                 raise HTTPException(
                     status_code=402,
                     detail=f"Insufficient credits. Required: {amount}, Available: {total_available}. Please purchase more credits or upgrade your plan."
                 )
             
-            # Deduct credits (prefer rollover first)
-            if subscription.credits_rollover >= amount:
-                subscription.credits_rollover -= amount
-            else:
-                remainder = amount - subscription.credits_rollover
-                subscription.credits_rollover = 0
-                subscription.credits_remaining -= remainder
+            # Execute the function
+            result = await endpoint(*args, **kwargs)
             
-            # Create transaction record
-            transaction = models.CreditTransaction(
+            # Commit after successful execution
+            await db.commit()
+            
+            # Record the usage once the deduction is committed
+            credit_consumer.record(
                 user_id=current_user.id,
-                subscription_id=subscription.id,
+                subscription_id=subscription_id,
                 amount=-amount,
                 transaction_type="usage",
                 description=description or f"{operation_type} operation",
-                metadata_json={"operation_type": operation_type}
+                metadata={"operation_type": operation_type}
             )
-            db.add(transaction)
-            
-            # Execute the function
-            result = await func(*args, **kwargs)
-            
-            # Commit after successful execution
-            await db.commit()
-            await db.refresh(subscription)
             
             return result
         
@@ -146,12 +182,7 @@ def check_feature(feature_name: str):
                 raise HTTPException(status_code=500, detail="Missing required dependencies")
             
             # Get user's plan
-            result = await db.execute(
-                select(models.Subscription, models.Plan)
-                .join(models.Plan, models.Subscription.plan_id == models.Plan.id)
-                .where(models.Subscription.user_id == current_user.id)
-            )
-            row = result.first()
+            row = await get_user_plan(current_user.id, db)
             
             if not row:
                 raise HTTPException(status_code=403, detail="No active subscription")
@@ -172,6 +203,128 @@ def check_feature(feature_name: str):
         return wrapper
     return decorator
 
+# Plan limits and document counts change rarely; keep them briefly in Redis
+SUBSCRIPTION_CACHE_TTL = 10  # seconds
+
+# Increment a counter only if it is already cached, so a missing key is
+# recomputed from the database instead of starting from zero
+_INCR_IF_EXISTS = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('INCRBY', KEYS[1], ARGV[1])
+end
+return nil
+"""
+
+async def get_plan_limits(user_id: int, db: AsyncSession) -> Optional[Dict[str, Any]]:
+    """
+    Get the limits of a user's current plan
+    Served from Redis when possible; returns None if the user has no subscription
+    """
+    key = f"sub:{user_id}"
+    try:
+        cache = await get_cache()
+        cached = await cache.get(key)
+        if cached is not None:
+            return cached
+    except Exception:
+        # Redis unavailable - fall back to the database
+        cache = None
+    
+    result = await db.execute(
+        select(
+            models.Plan.name,
+            models.Plan.max_documents,
+            models.Plan.max_collaborators,
+            models.Plan.max_file_size_mb
+        )
+        .join(models.Subscription, models.Subscription.plan_id == models.Plan.id)
+        .where(models.Subscription.user_id == user_id)
+    )
+    row = result.first()
+    
+    if not row:
+        return None
+    
+    limits = dict(row._mapping)
+    if cache:
+        try:
+            await cache.set(key, limits, SUBSCRIPTION_CACHE_TTL)
+        except Exception:
+            pass
+    return limits
+
+async def invalidate_plan_limits(user_id: int) -> None:
+    """Drop cached plan limits after a user's plan changes"""
+    try:
+        cache = await get_cache()
+        await cache.delete(f"sub:{user_id}")
+    except Exception:
+        pass
+
+# The free plan row is read once per process and merged into callers'
+# sessions without a query
+_free_plan: Optional[models.Plan] = None
+_free_plan_lock = asyncio.Lock()
+
+async def get_free_plan(db: AsyncSession) -> Optional[models.Plan]:
+    """
+    Get the free plan as an instance attached to the given session
+    Loaded on first use; returns None if the plan has not been created
+    """
+    global _free_plan
+    if _free_plan is None:
+        async with _free_plan_lock:
+            if _free_plan is None:
+                # Load on a separate session so the cached instance is
+                # detached and never shared with a request's session
+                async with async_session_maker() as session:
+                    result = await session.execute(
+                        select(models.Plan).where(models.Plan.name == "free")
+                    )
+                    _free_plan = result.scalar_one_or_none()
+                if _free_plan is None:
+                    return None
+    return await db.merge(_free_plan, load=False)
+
+def invalidate_free_plan() -> None:
+    """Forget the cached free plan so it is reloaded on next use"""
+    global _free_plan
+    _free_plan = None
+
+async def get_document_count(user_id: int, db: AsyncSession) -> int:
+    """
+    Count a user's documents
+    Served from Redis when possible; kept current by adjust_document_count
+    """
+    key = f"doc_count:{user_id}"
+    try:
+        redis_client = await get_redis()
+        cached = await redis_client.get(key)
+        if cached is not None:
+            return int(cached)
+    except Exception:
+        redis_client = None
+    
+    count_result = await db.execute(
+        select(func.count()).select_from(models.Document).where(models.Document.owner_id == user_id)
+    )
+    doc_count = count_result.scalar_one()
+    
+    if redis_client:
+        try:
+            await redis_client.set(key, doc_count, ex=SUBSCRIPTION_CACHE_TTL)
+        except Exception:
+            pass
+    return doc_count
+
+async def adjust_document_count(user_id: int, delta: int) -> None:
+    """Apply a document create (+1) or delete (-1) to the cached count"""
+    try:
+        redis_client = await get_redis()
+        await redis_client.eval(_INCR_IF_EXISTS, 1, f"doc_count:{user_id}", delta)
+    except Exception:
+        pass
+
 async def check_file_size_limit(
     file_size: int,
     current_user: models.User,
@@ -180,26 +333,19 @@ async def check_file_size_limit(
     """
     Check if file size is within user's plan limit
     """
-    result = await db.execute(
-        select(models.Subscription, models.Plan)
-        .join(models.Plan, models.Subscription.plan_id == models.Plan.id)
-        .where(models.Subscription.user_id == current_user.id)
-    )
-    row = result.first()
+    limits = await get_plan_limits(current_user.id, db)
     
-    if not row:
+    if not limits:
         return False
     
-    subscription, plan = row
-    
     # Convert to MB
     file_size_mb = file_size / (1024 * 1024)
     
     # Check limit (-1 means unlimited)
-    if plan.max_file_size_mb != -1 and file_size_mb > plan.max_file_size_mb:
+    if limits["max_file_size_mb"] != -1 and file_size_mb > limits["max_file_size_mb"]:
         raise HTTPException(
             status_code=413,  # Request Entity Too Large
-            detail=f"File size ({file_size_mb:.2f}MB) exceeds your plan limit ({plan.max_file_size_mb}MB). Please upgrade to upload larger files."
+            detail=f"File size ({file_size_mb:.2f}MB) exceeds your plan limit ({limits['max_file_size_mb']}MB). Please upgrade to upload larger files."
         )
     
     return True
@@ -211,32 +357,24 @@ async def check_document_limit(
     """
     Check if user has reached document limit
     """
-    result = await db.execute(
-        select(models.Subscription, models.Plan)
-        .join(models.Plan, models.Subscription.plan_id == models.Plan.id)
-        .where(models.Subscription.user_id == current_user.id)
-    )
-    row = result.first()
+    limits = await get_plan_limits(current_user.id, db)
     
-    if not row:
+    if not limits:
         return False
     
-    subscription, plan = row
+    max_documents = limits["max_documents"]
     
     # Check if plan has unlimited documents
-    if plan.max_documents is None or plan.max_documents == -1:
+    if max_documents is None or max_documents == -1:
         return True
     
     # Count user's documents
-    count_result = await db.execute(
-        select(models.Document).where(models.Document.owner_id == current_user.id)
-    )
-    doc_count = len(count_result.scalars().all())
+    doc_count = await get_document_count(current_user.id, db)
     
-    if doc_count >= plan.max_documents:
+    if doc_count >= max_documents:
         raise HTTPException(
             status_code=402,
-            detail=f"Document limit reached ({doc_count}/{plan.max_documents}). Please upgrade your plan or delete old documents."
+            detail=f"Document limit reached ({doc_count}/{max_documents}). Please upgrade your plan or delete old documents."
         )
     
     return True
@@ -249,42 +387,36 @@ async def check_collaborator_limit(
     """
     Check if document has reached collaborator limit
     """
-    # Get document to find owner
-    doc_result = await db.execute(
-        select(models.Document).where(models.Document.id == document_id)
+    # Get document owner (not the whole document with its content)
+    owner_id = await db.scalar(
+        select(models.Document.owner_id).where(models.Document.id == document_id)
     )
-    doc = doc_result.scalar_one_or_none()
-    if not doc:
+    if owner_id is None:
         return False
     
-    # Get document owner's subscription
-    result = await db.execute(
-        select(models.Subscription, models.Plan)
-        .join(models.Plan, models.Subscription.plan_id == models.Plan.id)
-        .where(models.Subscription.user_id == doc.owner_id)
-    )
-    row = result.first()
+    # Get document owner's plan limits
+    limits = await get_plan_limits(owner_id, db)
     
-    if not row:
+    if not limits:
         return False
     
-    subscription, plan = row
+    max_collaborators = limits["max_collaborators"]
     
     # Check if plan has unlimited collaborators
-    if plan.max_collaborators == -1:
+    if max_collaborators == -1:
         return True
     
     # Count current collaborators (excluding owner)
-    collaborator_result = await db.execute(
-        select(models.DocumentCollaborator)
+    collaborator_count = await db.scalar(
+        select(func.count())
+        .select_from(models.DocumentCollaborator)
         .where(models.DocumentCollaborator.document_id == document_id)
     )
-    collaborator_count = len(collaborator_result.scalars().all())
     
-    if collaborator_count >= plan.max_collaborators:
+    if collaborator_count >= max_collaborators:
         raise HTTPException(
             status_code=402,
-            detail=f"Collaborator limit reached ({collaborator_count}/{plan.max_collaborators}). Upgrade to add more collaborators."
+            detail=f"Collaborator limit reached ({collaborator_count}/{max_collaborators}). Upgrade to add more collaborators."
         )
     
     return True
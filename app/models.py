@@ -1,8 +1,16 @@
-from sqlalchemy import Column, String, DateTime, ForeignKey, Integer, Text, JSON, Boolean, Numeric
+from sqlalchemy import Column, String, DateTime, ForeignKey, Integer, Text, JSON, Boolean, Numeric, Index, CheckConstraint
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from .db import Base
 
+def _trigram_search_enabled(ddl, target, bind, **kw) -> bool:
+    """
+    Skip the trigram indexes where pg_trgm and btree_gin are not installed
+    init_db records this on the connection before creating the schema
+    """
+    return getattr(bind, "info", {}).get("trigram_search", True)
+
 class User(Base):
     __tablename__ = "users"
     id = Column(Integer, unique=True, primary_key=True)
@@ -24,6 +32,19 @@ class Upload(Base):
     error_message = Column(Text, nullable=True)
     updated_at = Column(DateTime(timezone=True), onupdate=func.now()) 
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    
+    __table_args__ = (
+        # Trigram index for ILIKE '%q%' filename search, scoped by owner (pg_trgm + btree_gin)
+        Index(
+            "ix_uploads_user_filename_trgm",
+            "user_id",
+            "original_filename",
+            postgresql_using="gin",
+            postgresql_ops={"original_filename": "gin_trgm_ops"},
+        ).ddl_if(callable_=_trigram_search_enabled),
+        # Serves a user's newest uploads without a sort
+        Index("ix_uploads_user_created", user_id, created_at.desc()),
+    )
 
 class AuditResult(Base):
     __tablename__ = "audit_results"
@@ -34,6 +55,11 @@ class AuditResult(Base):
     result_json = Column(JSON, nullable=False)
     status = Column(String, default="completed")
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    
+    __table_args__ = (
+        # Newest-first listing of a user's results
+        Index("ix_audit_results_user_created", user_id, created_at.desc()),
+    )
 
 class Document(Base):
     __tablename__ = "documents"
@@ -43,6 +69,19 @@ class Document(Base):
     owner_id = Column(ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+    
+    __table_args__ = (
+        # Trigram index for ILIKE '%q%' title search, scoped by owner (pg_trgm + btree_gin)
+        Index(
+            "ix_documents_owner_title_trgm",
+            "owner_id",
+            "title",
+            postgresql_using="gin",
+            postgresql_ops={"title": "gin_trgm_ops"},
+        ).ddl_if(callable_=_trigram_search_enabled),
+        # Newest-first listing of a user's documents
+        Index("ix_documents_owner_created", owner_id, created_at.desc()),
+    )
 
 class DocumentVersion(Base):
     __tablename__ = "document_versions"
@@ -51,6 +90,14 @@ class DocumentVersion(Base):
     content = Column(Text, nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     created_by = Column(ForeignKey("users.id", ondelete="SET NULL"), nullable=True)
+    
+    # Relationships
+    creator = relationship("User", foreign_keys=[created_by])
+    
+    __table_args__ = (
+        # Version history, newest first
+        Index("ix_document_versions_document_created", document_id, created_at.desc()),
+    )
 
 class Comment(Base):
     __tablename__ = "comments"
@@ -62,6 +109,11 @@ class Comment(Base):
     position_end = Column(Integer, nullable=True)
     resolved = Column(Boolean, default=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    
+    __table_args__ = (
+        # Comments of a document, newest first
+        Index("ix_comments_document_created", document_id, created_at.desc()),
+    )
 
 class DocumentCollaborator(Base):
     __tablename__ = "document_collaborators"
@@ -113,8 +165,9 @@ class Subscription(Base):
     trial_ends_at = Column(DateTime(timezone=True), nullable=True)
     current_period_start = Column(DateTime(timezone=True), server_default=func.now())
     current_period_end = Column(DateTime(timezone=True), nullable=True)
-    stripe_customer_id = Column(String, nullable=True)
-    stripe_subscription_id = Column(String, nullable=True)
+    # Indexed for the webhook handlers, which look subscriptions up by Stripe id
+    stripe_customer_id = Column(String, nullable=True, index=True)
+    stripe_subscription_id = Column(String, unique=True, nullable=True, index=True)
     cancelled_at = Column(DateTime(timezone=True), nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
@@ -122,6 +175,12 @@ class Subscription(Base):
     # Relationships
     user = relationship("User", backref="subscription")
     plan = relationship("Plan")
+    
+    __table_args__ = (
+        # Covering index for the plan lookups by user (index-only scans); credit
+        # columns are left out so balance updates stay HOT
+        Index("ix_subscriptions_user_plan", user_id, postgresql_include=["plan_id", "status"]),
+    )
 
 class CreditTransaction(Base):
     """Credit usage and purchase history"""
@@ -133,7 +192,8 @@ class CreditTransaction(Base):
     amount = Column(Integer, nullable=False)  # Positive for credits added, negative for used
     transaction_type = Column(String, nullable=False)  # usage, purchase, bonus, refund, trial, rollover, signup
     description = Column(String, nullable=False)
-    metadata_json = Column(JSON, nullable=True)  # Store details like document_id, analysis_type, referral_id
+    # Written with every transaction; JSONB is stored parsed and compact on Postgres
+    metadata_json = Column(JSON().with_variant(JSONB(), "postgresql"), nullable=True)  # Store details like document_id, analysis_type, referral_id
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     
     # Relationships
@@ -156,6 +216,13 @@ class Referral(Base):
     # Relationships
     referrer = relationship("User", foreign_keys=[referrer_id])
     referee = relationship("User", foreign_keys=[referee_id])
+    
+    __table_args__ = (
+        # Codes are canonical uppercase, so lookups are plain equality
+        CheckConstraint("referral_code = upper(referral_code)", name="ck_referrals_code_upper"),
+        # Hash index: smaller and faster than the B-tree for equality-only lookups
+        Index("ix_referrals_code_hash", "referral_code", postgresql_using="hash"),
+    )
 
 class CreditCost(Base):
     """Configurable credit costs for different operations"""
@@ -1,5 +1,5 @@
-from pydantic import BaseModel, EmailStr, Field, ConfigDict
-from typing import Optional, Dict, Any, Generic, TypeVar, List
+from pydantic import BaseModel, EmailStr, Field, ConfigDict, StringConstraints, computed_field
+from typing import Optional, Dict, Any, Generic, TypeVar, List, Annotated
 from datetime import datetime
 
 T = TypeVar("T")
@@ -11,6 +11,10 @@ class PaginatedResponse(BaseModel, Generic[T]):
     size: int
     pages: int
 
+class CursorPage(BaseModel, Generic[T]):
+    items: List[T]
+    next_cursor: Optional[str] = None
+
 # User Schemas
 class UserCreate(BaseModel):
     email: EmailStr
@@ -126,14 +130,29 @@ class CommentResponse(BaseModel):
     model_config = ConfigDict(from_attributes=True)
 
 # Version Schemas
+class VersionCreator(BaseModel):
+    email: str
+    full_name: Optional[str]
+    
+    model_config = ConfigDict(from_attributes=True)
+
 class DocumentVersionResponse(BaseModel):
     id: int
     document_id: int
     content: str
     created_at: datetime
     created_by: Optional[int]
-    created_by_email: Optional[str] = None
-    created_by_name: Optional[str] = None
+    creator: Optional[VersionCreator] = Field(None, exclude=True)
+    
+    @computed_field
+    @property
+    def created_by_email(self) -> Optional[str]:
+        return self.creator.email if self.creator else None
+    
+    @computed_field
+    @property
+    def created_by_name(self) -> Optional[str]:
+        return self.creator.full_name if self.creator else None
     
     model_config = ConfigDict(from_attributes=True)
 
@@ -228,6 +247,9 @@ class ConsumeCreditsRequest(BaseModel):
     metadata: Optional[Dict[str, Any]] = None
 
 # Referral Schemas
+# Codes are stored uppercase; normalize user input once at validation
+ReferralCode = Annotated[str, StringConstraints(strip_whitespace=True, to_upper=True)]
+
 class ReferralResponse(BaseModel):
     id: int
     referral_code: str
@@ -246,7 +268,7 @@ class ReferralStatsResponse(BaseModel):
     total_credits_earned: int
 
 class ApplyReferralRequest(BaseModel):
-    referral_code: str
+    referral_code: ReferralCode
 
 # Usage Stats Schemas
 class UsageStatsResponse(BaseModel):
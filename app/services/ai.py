@@ -1,5 +1,42 @@
 from app.services.huggingface import hf_service
-from typing import Dict, Any, List
+from app.cache import get_redis
+from typing import Dict, Any, List, AsyncIterator, Optional, Set
+import asyncio
+import logging
+import time
+import uuid
+import orjson
+
+logger = logging.getLogger(__name__)
+
+# Finished suggestions wait this long in Redis for their SSE reader
+SUGGESTION_JOB_TTL = 300  # seconds
+# How long an SSE reader waits for a suggestion before giving up
+SUGGESTION_STREAM_TIMEOUT = 120  # seconds
+SUGGESTION_KEEPALIVE_INTERVAL = 15  # seconds
+
+# Jobs run in-process, so a restart or redeploy loses the ones in flight
+# after their credits were charged. Each job is tracked in Redis until its
+# result is published; jobs not done by their deadline are run again by
+# whichever worker's check finds them first
+SUGGESTION_PENDING_KEY = "ai_jobs:pending"  # sorted set: job key -> deadline
+SUGGESTION_PAYLOAD_KEY = "ai_jobs:payload"  # hash: job key -> context and selection
+SUGGESTION_STALE_AFTER = SUGGESTION_STREAM_TIMEOUT  # seconds
+SUGGESTION_STALE_CHECK_INTERVAL = 30  # seconds
+
+# Claim the jobs past their deadline by moving the deadline forward, in one
+# step so a job is resubmitted by one worker only
+_CLAIM_STALE_JOBS = """
+local keys = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+for _, key in ipairs(keys) do
+    redis.call('ZADD', KEYS[1], ARGV[2], key)
+end
+return keys
+"""
+
+# Strong references to running jobs so they are not garbage collected
+_suggestion_jobs: Set[asyncio.Task] = set()
+_stale_suggestion_reaper: Optional[asyncio.Task] = None
 
 async def generate_suggestion(context: str, selection: str = "") -> Dict[str, Any]:
     """
@@ -86,6 +123,150 @@ Return ONLY valid JSON."""
         }
 
 
+def _suggestion_job_key(doc_id: int, job_id: str) -> str:
+    return f"ai_job:{doc_id}:{job_id}"
+
+
+async def submit_suggestion(doc_id: int, context: str, selection: str = "") -> str:
+    """
+    Run generate_suggestion in the background.
+    
+    The result is pushed to Redis when ready and read back with
+    stream_suggestion.
+    
+    Args:
+        doc_id: Document the suggestion is for
+        context: The surrounding text context
+        selection: The selected text to analyze (optional)
+        
+    Returns:
+        Job ID to stream the result with
+        
+    Raises:
+        Exception: If Redis is unreachable
+    """
+    redis_client = await get_redis()
+    
+    job_id = uuid.uuid4().hex
+    key = _suggestion_job_key(doc_id, job_id)
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(SUGGESTION_PAYLOAD_KEY, key, orjson.dumps({"context": context, "selection": selection}).decode())
+        pipe.zadd(SUGGESTION_PENDING_KEY, {key: time.time() + SUGGESTION_STALE_AFTER})
+        await pipe.execute()
+    
+    _start_suggestion_job(key, context, selection)
+    return job_id
+
+
+def _start_suggestion_job(key: str, context: str, selection: str) -> None:
+    task = asyncio.create_task(_run_suggestion_job(key, context, selection))
+    _suggestion_jobs.add(task)
+    task.add_done_callback(_suggestion_jobs.discard)
+
+
+async def _run_suggestion_job(key: str, context: str, selection: str) -> None:
+    """Generate a suggestion and hand it to the waiting reader."""
+    result = await generate_suggestion(context, selection)
+    try:
+        redis_client = await get_redis()
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.rpush(key, orjson.dumps(result).decode())
+            pipe.expire(key, SUGGESTION_JOB_TTL)
+            pipe.zrem(SUGGESTION_PENDING_KEY, key)
+            pipe.hdel(SUGGESTION_PAYLOAD_KEY, key)
+            await pipe.execute()
+    except Exception:
+        # Still pending, so the job is run again once its deadline passes
+        logger.exception("Failed to publish AI suggestion %s", key)
+
+
+async def resubmit_stale_suggestions() -> int:
+    """
+    Run again the suggestion jobs lost with the process that ran them.
+    
+    Returns:
+        Number of jobs resubmitted
+    """
+    redis_client = await get_redis()
+    now = time.time()
+    keys = await redis_client.eval(
+        _CLAIM_STALE_JOBS, 1, SUGGESTION_PENDING_KEY, now, now + SUGGESTION_STALE_AFTER
+    )
+    if not keys:
+        return 0
+    
+    payloads = await redis_client.hmget(SUGGESTION_PAYLOAD_KEY, keys)
+    resubmitted = 0
+    for key, payload in zip(keys, payloads):
+        if payload is None:
+            await redis_client.zrem(SUGGESTION_PENDING_KEY, key)
+            continue
+        job = orjson.loads(payload)
+        _start_suggestion_job(key, job["context"], job["selection"])
+        resubmitted += 1
+    return resubmitted
+
+
+async def _reap_stale_suggestions() -> None:
+    """Periodically resubmit lost suggestion jobs."""
+    while True:
+        try:
+            await resubmit_stale_suggestions()
+        except Exception:
+            logger.warning("Could not resubmit stale AI suggestions", exc_info=True)
+        await asyncio.sleep(SUGGESTION_STALE_CHECK_INTERVAL)
+
+
+def start_stale_suggestion_reaper() -> None:
+    """Start the background check for lost suggestion jobs."""
+    global _stale_suggestion_reaper
+    if _stale_suggestion_reaper is None or _stale_suggestion_reaper.done():
+        _stale_suggestion_reaper = asyncio.create_task(_reap_stale_suggestions())
+
+
+async def close_suggestion_jobs() -> None:
+    """Stop the stale job check and let running suggestion jobs finish."""
+    global _stale_suggestion_reaper
+    if _stale_suggestion_reaper is not None:
+        _stale_suggestion_reaper.cancel()
+        try:
+            await _stale_suggestion_reaper
+        except asyncio.CancelledError:
+            pass
+        _stale_suggestion_reaper = None
+    if _suggestion_jobs:
+        await asyncio.gather(*_suggestion_jobs, return_exceptions=True)
+
+
+async def stream_suggestion(doc_id: int, job_id: str) -> AsyncIterator[str]:
+    """
+    Yield Server-Sent Events for a suggestion job.
+    
+    Sends keep-alive comments while waiting, then a single "suggestion"
+    event with the result, or a "timeout" event.
+    
+    Args:
+        doc_id: Document the job was submitted for
+        job_id: Job ID returned by submit_suggestion
+        
+    Yields:
+        SSE-formatted messages
+    """
+    key = _suggestion_job_key(doc_id, job_id)
+    redis_client = await get_redis()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + SUGGESTION_STREAM_TIMEOUT
+    
+    while loop.time() < deadline:
+        item = await redis_client.blpop([key], timeout=SUGGESTION_KEEPALIVE_INTERVAL)
+        if item:
+            yield f"event: suggestion\ndata: {item[1]}\n\n"
+            return
+        yield ": keep-alive\n\n"
+    
+    yield "event: timeout\ndata: {}\n\n"
+
+
 async def analyze_document_quality(text: str) -> Dict[str, Any]:
     """
     Analyze overall document quality using AI.
@@ -0,0 +1,99 @@
+"""
+Analysis Batcher - Micro-batched text analysis.
+
+Collects concurrent analyze requests for up to FLUSH_INTERVAL seconds (or
+BATCH_SIZE requests) and sends them to the model as batched requests. Only
+texts from the same user share a prompt, and each prompt stays within
+MAX_BATCH_CHARS. Callers still await their own result.
+"""
+
+import asyncio
+from typing import Any, Dict, List, Set, Tuple
+
+from app.services.batching import BatchWorker
+from app.services.huggingface import hf_service
+
+
+# A queued text with its owner and the future its caller awaits
+AnalysisRequest = Tuple[int, str, asyncio.Future]
+
+
+class AnalysisBatcher(BatchWorker[AnalysisRequest]):
+    """Batching front-end for ``hf_service.analyze_text``."""
+
+    BATCH_SIZE = 16
+    FLUSH_INTERVAL = 0.025  # seconds
+    # Longer texts are analyzed on their own to stay within the model context
+    MAX_BATCH_TEXT_LENGTH = 8000  # characters
+    # Total text in one batched prompt
+    MAX_BATCH_CHARS = 16000  # characters
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._in_flight: Set[asyncio.Task] = set()
+
+    async def analyze(self, text: str, user_id: int) -> Dict[str, Any]:
+        """
+        Queue a text for analysis and wait for its batch to complete.
+
+        Args:
+            text: Text to analyze
+            user_id: Owner of the text; only texts of one user share a prompt
+
+        Returns:
+            Analysis result, as returned by ``hf_service.analyze_text``
+        """
+        if len(text) > self.MAX_BATCH_TEXT_LENGTH:
+            return await hf_service.analyze_text(text)
+
+        future = asyncio.get_running_loop().create_future()
+        self._put((user_id, text, future))
+        return await future
+
+    async def close(self) -> None:
+        """Analyze pending texts and stop the background worker."""
+        await super().close()
+        if self._in_flight:
+            await asyncio.gather(*self._in_flight)
+
+    async def _dispatch(self, batch: List[AnalysisRequest]) -> None:
+        """
+        Split a batch per user and by MAX_BATCH_CHARS, and flush the parts
+        without holding up the next batch while they are in flight.
+        """
+        by_user: Dict[int, List[AnalysisRequest]] = {}
+        for request in batch:
+            by_user.setdefault(request[0], []).append(request)
+
+        for requests in by_user.values():
+            part: List[AnalysisRequest] = []
+            part_chars = 0
+            for request in requests:
+                if part and part_chars + len(request[1]) > self.MAX_BATCH_CHARS:
+                    self._start_flush(part)
+                    part, part_chars = [], 0
+                part.append(request)
+                part_chars += len(request[1])
+            self._start_flush(part)
+
+    def _start_flush(self, batch: List[AnalysisRequest]) -> None:
+        task = asyncio.create_task(self._flush(batch))
+        self._in_flight.add(task)
+        task.add_done_callback(self._in_flight.discard)
+
+    async def _flush(self, batch: List[AnalysisRequest]) -> None:
+        """Analyze a batch with one model request and resolve its futures."""
+        try:
+            results = await hf_service.analyze_texts([text for _, text, _ in batch])
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, _, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+# Global instance
+analysis_batcher = AnalysisBatcher()
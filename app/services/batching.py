@@ -0,0 +1,85 @@
+"""
+Batch Worker - Shared queue and background worker for batching services.
+
+Callers queue items; a background worker hands them to ``_flush`` in
+batches of up to BATCH_SIZE items, or whatever arrived within
+FLUSH_INTERVAL seconds of the first one, whichever comes first.
+"""
+
+import asyncio
+from typing import Generic, List, Optional, TypeVar
+
+T = TypeVar("T")
+
+# Queued by close(): the worker stops once everything queued before it is flushed
+_STOP = None
+
+
+class BatchWorker(Generic[T]):
+    """Base class for the batching services; subclasses implement ``_flush``."""
+
+    BATCH_SIZE = 100
+    FLUSH_INTERVAL = 0.05  # seconds
+
+    def __init__(self) -> None:
+        self._queue: "asyncio.Queue[Optional[T]]" = asyncio.Queue()
+        self._worker: Optional[asyncio.Task] = None
+
+    def _put(self, item: T) -> None:
+        """Queue an item, starting the worker on first use."""
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        self._queue.put_nowait(item)
+
+    async def close(self) -> None:
+        """Flush pending items and stop the background worker."""
+        if self._worker is None:
+            return
+        # The worker exits once it reaches the sentinel, after flushing every
+        # item queued before it; it is never cancelled mid-batch or mid-flush
+        if not self._worker.done():
+            await self._queue.put(_STOP)
+        await self._worker
+        self._worker = None
+
+        # Anything queued after the sentinel
+        pending: List[T] = []
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is not _STOP:
+                pending.append(item)
+        for start in range(0, len(pending), self.BATCH_SIZE):
+            await self._dispatch(pending[start:start + self.BATCH_SIZE])
+
+    async def _run(self) -> None:
+        """Collect queued items into batches and dispatch them."""
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._queue.get()
+            if item is _STOP:
+                return
+            batch = [item]
+            stopping = False
+            deadline = loop.time() + self.FLUSH_INTERVAL
+            while len(batch) < self.BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._dispatch(batch)
+            if stopping:
+                return
+
+    async def _dispatch(self, batch: List[T]) -> None:
+        """Flush a collected batch; overridden to run flushes concurrently."""
+        await self._flush(batch)
+
+    async def _flush(self, batch: List[T]) -> None:
+        raise NotImplementedError
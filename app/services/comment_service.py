@@ -49,7 +49,6 @@ class CommentService:
         )
         self.db.add(new_comment)
         await self.db.commit()
-        await self.db.refresh(new_comment)
         return new_comment
     
     async def get_comments(self, document_id: int) -> List[models.Comment]:
@@ -95,5 +94,4 @@ class CommentService:
         
         comment.resolved = True
         await self.db.commit()
-        await self.db.refresh(comment)
         return comment
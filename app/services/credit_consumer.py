@@ -0,0 +1,210 @@
+"""
+Credit Consumer - Buffered credit consumption.
+
+Groups credit consumption events from many callers into a single
+database transaction, flushed every BATCH_SIZE events or FLUSH_INTERVAL
+seconds, whichever comes first. Callers of ``consume`` still await their
+own result; usage already deducted elsewhere is queued with ``record`` and
+its transaction row is inserted with the next batch.
+"""
+
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+from sqlalchemy import select, update, insert
+from fastapi import HTTPException
+
+from app import models
+from app.db import async_session_maker
+from app.services.batching import BatchWorker
+
+logger = logging.getLogger(__name__)
+
+# A queued event and the future its caller awaits; record() events have none
+CreditEvent = Tuple[Dict[str, Any], Optional[asyncio.Future]]
+
+
+class CreditConsumer(BatchWorker[CreditEvent]):
+    """
+    Opt-in batching alternative to ``consume_credits``; also inserts the
+    transaction rows for the ``consume_credits`` decorator.
+    """
+
+    BATCH_SIZE = 100
+    FLUSH_INTERVAL = 0.05  # seconds
+    # Waits before each retry of record() rows whose batch failed
+    RECORD_RETRY_DELAYS = (0.5, 2.0, 8.0)  # seconds
+
+    async def consume(
+        self,
+        user_id: int,
+        amount: int,
+        description: str,
+        metadata: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, int]:
+        """
+        Queue a credit consumption and wait for the batch to be committed.
+
+        Args:
+            user_id: User whose credits are consumed
+            amount: Number of credits to consume
+            description: Transaction description
+            metadata: Optional transaction metadata
+
+        Returns:
+            Dictionary with credits_consumed and credits_remaining
+
+        Raises:
+            HTTPException: If the user has no subscription or not enough credits
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._put(({
+            "user_id": user_id,
+            "amount": amount,
+            "description": description,
+            "metadata": metadata or {}
+        }, future))
+        return await future
+
+    def record(
+        self,
+        user_id: int,
+        subscription_id: int,
+        amount: int,
+        transaction_type: str,
+        description: str,
+        metadata: Optional[Dict[str, Any]] = None
+    ) -> None:
+        """
+        Queue the transaction row for credits that were already deducted.
+
+        Args:
+            user_id: User the transaction belongs to
+            subscription_id: Subscription the credits were taken from
+            amount: Credits added (positive) or used (negative)
+            transaction_type: usage, purchase, bonus, ...
+            description: Transaction description
+            metadata: Optional transaction metadata
+        """
+        self._put(({
+            "user_id": user_id,
+            "subscription_id": subscription_id,
+            "amount": amount,
+            "transaction_type": transaction_type,
+            "description": description,
+            "metadata_json": metadata
+        }, None))
+
+    async def _flush(self, batch: List[CreditEvent]) -> None:
+        """
+        Apply a batch of consumption events in one transaction.
+
+        Subscriptions are locked with FOR UPDATE so the balance check for
+        each event sees the deductions of the events before it.
+        """
+        consumed = [(event, future) for event, future in batch if future is not None]
+        recorded = [event for event, future in batch if future is None]
+        results: List[Any] = []
+        try:
+            async with async_session_maker() as session:
+                balances: Dict[int, Dict[str, int]] = {}
+                if consumed:
+                    user_ids = {event["user_id"] for event, _ in consumed}
+                    sub_result = await session.execute(
+                        select(models.Subscription)
+                        .where(models.Subscription.user_id.in_(user_ids))
+                        .with_for_update()
+                    )
+                    balances = {
+                        sub.user_id: {
+                            "id": sub.id,
+                            "credits_remaining": sub.credits_remaining,
+                            "credits_rollover": sub.credits_rollover
+                        }
+                        for sub in sub_result.scalars()
+                    }
+
+                transactions = []
+                for event, _ in consumed:
+                    balance = balances.get(event["user_id"])
+                    amount = event["amount"]
+                    if balance is None:
+                        results.append(HTTPException(status_code=404, detail="No subscription found"))
+                        continue
+
+                    total_available = balance["credits_remaining"] + balance["credits_rollover"]
+                    if total_available < amount:
+                        results.append(HTTPException(
+                            status_code=402,
+                            detail=f"Insufficient credits. Required: {amount}, Available: {total_available}"
+                        ))
+                        continue
+
+                    # Deduct credits (prefer using rollover credits first)
+                    if balance["credits_rollover"] >= amount:
+                        balance["credits_rollover"] -= amount
+                    else:
+                        balance["credits_remaining"] -= amount - balance["credits_rollover"]
+                        balance["credits_rollover"] = 0
+
+                    transactions.append({
+                        "user_id": event["user_id"],
+                        "subscription_id": balance["id"],
+                        "amount": -amount,
+                        "transaction_type": "usage",
+                        "description": event["description"],
+                        "metadata_json": event["metadata"]
+                    })
+                    results.append({
+                        "credits_consumed": amount,
+                        "credits_remaining": balance["credits_remaining"] + balance["credits_rollover"]
+                    })
+
+                if transactions:
+                    await session.execute(update(models.Subscription), list(balances.values()))
+                if transactions or recorded:
+                    await session.execute(insert(models.CreditTransaction), recorded + transactions)
+                    await session.commit()
+        except Exception as e:
+            logger.exception("Could not apply a batch of %d credit events", len(batch))
+            # consume() callers were not charged and see the error
+            for _, future in consumed:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for (_, future), result in zip(consumed, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+            return
+
+        # The deductions behind record() rows are committed; retried outside
+        # the except block so retry errors are not chained onto this one
+        if recorded:
+            await self._retry_recorded(recorded)
+
+    async def _retry_recorded(self, rows: List[Dict[str, Any]]) -> None:
+        """
+        Retry inserting transaction rows for credits that are already deducted.
+
+        The balances are committed, so these rows are retried with backoff
+        rather than dropped; rows that still fail are logged in full so the
+        ledger can be reconciled.
+        """
+        for delay in self.RECORD_RETRY_DELAYS:
+            await asyncio.sleep(delay)
+            try:
+                async with async_session_maker() as session:
+                    await session.execute(insert(models.CreditTransaction), rows)
+                    await session.commit()
+                return
+            except Exception:
+                logger.exception("Retrying %d credit transaction rows failed", len(rows))
+        logger.error("Could not record %d credit transactions: %r", len(rows), rows)
+
+
+# Global instance
+credit_consumer = CreditConsumer()
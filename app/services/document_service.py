@@ -5,13 +5,23 @@ This service encapsulates all document-related business logic,
 separating it from the API layer for better maintainability and testability.
 """
 
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, AsyncIterator
+import asyncio
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func
+from sqlalchemy import select, update, func, and_
+from sqlalchemy.orm import selectinload
 from fastapi import HTTPException, status
 
 from app import models, schemas
+from app.db import async_session_maker, engine
 from app.api.credits import get_credit_cost, consume_credits
+from app.middleware.subscription import adjust_document_count
+from app.services.file_processor import FileProcessor
+from app.services.ai import generate_suggestion
+
+
+# Size of the slices large document content is streamed in
+CONTENT_CHUNK_SIZE = 64 * 1024  # characters
 
 
 class DocumentService:
@@ -44,7 +54,7 @@ class DocumentService:
         )
         self.db.add(new_doc)
         await self.db.commit()
-        await self.db.refresh(new_doc)
+        await adjust_document_count(owner_id, 1)
         return new_doc
     
     async def get_document(self, doc_id: int) -> models.Document:
@@ -71,6 +81,34 @@ class DocumentService:
             )
         return doc
     
+    @staticmethod
+    async def stream_content(doc_id: int) -> AsyncIterator[str]:
+        """
+        Stream a document's content in CONTENT_CHUNK_SIZE slices.
+        
+        The content is sliced in the database and read through a
+        server-side cursor, so the full text is never held in memory.
+        Uses its own connection as it outlives the request's session.
+        
+        Args:
+            doc_id: Document ID
+            
+        Yields:
+            Consecutive slices of the content
+        """
+        chunk = func.generate_series(
+            0,
+            (func.length(models.Document.content) - 1) // CONTENT_CHUNK_SIZE
+        ).column_valued("chunk")
+        async with engine.connect() as conn:
+            result = await conn.stream(
+                select(func.substr(models.Document.content, chunk * CONTENT_CHUNK_SIZE + 1, CONTENT_CHUNK_SIZE))
+                .where(models.Document.id == doc_id)
+                .order_by(chunk)
+            )
+            async for piece in result.scalars():
+                yield piece
+    
     async def get_documents_paginated(
         self,
         owner_id: int,
@@ -90,23 +128,27 @@ class DocumentService:
         """
         offset = (page - 1) * size
         
-        # Get total count
-        count_query = select(func.count()).select_from(models.Document).where(
-            models.Document.owner_id == owner_id
-        )
-        total_result = await self.db.execute(count_query)
-        total = total_result.scalar_one()
+        # Get total count (on its own session) concurrently with the page
+        async def count_documents() -> int:
+            async with async_session_maker() as session:
+                count_query = select(func.count()).select_from(models.Document).where(
+                    models.Document.owner_id == owner_id
+                )
+                total_result = await session.execute(count_query)
+                return total_result.scalar_one()
         
-        # Get items
-        query = (
-            select(models.Document)
-            .where(models.Document.owner_id == owner_id)
-            .order_by(models.Document.created_at.desc())
-            .offset(offset)
-            .limit(size)
-        )
-        result = await self.db.execute(query)
-        items = result.scalars().all()
+        async def fetch_page() -> List[models.Document]:
+            query = (
+                select(models.Document)
+                .where(models.Document.owner_id == owner_id)
+                .order_by(models.Document.created_at.desc())
+                .offset(offset)
+                .limit(size)
+            )
+            result = await self.db.execute(query)
+            return result.scalars().all()
+        
+        total, items = await asyncio.gather(count_documents(), fetch_page())
         
         return {
             "items": items,
@@ -118,7 +160,7 @@ class DocumentService:
     
     async def update_document(
         self,
-        doc_id: int,
+        doc: models.Document,
         title: Optional[str] = None,
         content: Optional[str] = None,
         created_by: Optional[int] = None
@@ -127,21 +169,18 @@ class DocumentService:
         Update a document.
         
         Args:
-            doc_id: Document ID
+            doc: Document to update (already loaded and authorized)
             title: New title (optional)
             content: New content (optional)
             created_by: User ID creating the version (for versioning)
             
         Returns:
             Updated document
-            
-        Raises:
-            HTTPException: If document not found
         """
-        doc = await self.get_document(doc_id)
+        values: Dict[str, Any] = {}
         
         if title is not None:
-            doc.title = title
+            values["title"] = title
         
         if content is not None:
             # Create a version before updating
@@ -151,10 +190,23 @@ class DocumentService:
                 created_by=created_by
             )
             self.db.add(version)
-            doc.content = content
+            values["content"] = content
+        
+        if values:
+            # RETURNING brings back the server-set updated_at without a refresh
+            result = await self.db.execute(
+                select(models.Document)
+                .from_statement(
+                    update(models.Document)
+                    .where(models.Document.id == doc.id)
+                    .values(**values)
+                    .returning(models.Document)
+                )
+                .execution_options(populate_existing=True)
+            )
+            doc = result.scalar_one()
         
         await self.db.commit()
-        await self.db.refresh(doc)
         return doc
     
     async def update_title(self, doc_id: int, title: str) -> models.Document:
@@ -167,27 +219,41 @@ class DocumentService:
             
         Returns:
             Updated document
+            
+        Raises:
+            HTTPException: If document not found
         """
-        doc = await self.get_document(doc_id)
-        doc.title = title
+        result = await self.db.execute(
+            select(models.Document)
+            .from_statement(
+                update(models.Document)
+                .where(models.Document.id == doc_id)
+                .values(title=title)
+                .returning(models.Document)
+            )
+            .execution_options(populate_existing=True)
+        )
+        doc = result.scalar_one_or_none()
+        if not doc:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Document not found"
+            )
         await self.db.commit()
-        await self.db.refresh(doc)
         return doc
     
-    async def delete_document(self, doc_id: int, owner_id: int) -> None:
+    async def delete_document(self, doc: models.Document, owner_id: int) -> None:
         """
         Delete a document.
         
         Args:
-            doc_id: Document ID
+            doc: Document to delete
             owner_id: Owner user ID (for authorization check)
             
         Raises:
-            HTTPException: If document not found or user not authorized
+            HTTPException: If user not authorized
         """
-        doc = await self.get_document(doc_id)
-        
-        # Check ownership
+        # Only the owner may delete; collaborators may not
         if doc.owner_id != owner_id:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
@@ -196,6 +262,7 @@ class DocumentService:
         
         await self.db.delete(doc)
         await self.db.commit()
+        await adjust_document_count(owner_id, -1)
     
     async def create_from_upload(
         self,
@@ -215,36 +282,45 @@ class DocumentService:
         Raises:
             HTTPException: If upload not found
         """
-        # Get the upload
+        # Fetch the upload, any existing document with the same title and
+        # whether it has been processed in one round-trip
         result = await self.db.execute(
-            select(models.Upload).where(models.Upload.id == upload_id)
+            select(models.Upload, models.Document.id, models.AuditResult.id)
+            .join(
+                models.Document,
+                and_(
+                    models.Document.owner_id == owner_id,
+                    models.Document.title == models.Upload.original_filename
+                ),
+                isouter=True
+            )
+            .join(
+                models.AuditResult,
+                models.AuditResult.upload_id == models.Upload.id,
+                isouter=True
+            )
+            .where(models.Upload.id == upload_id)
+            .limit(1)
         )
-        upload = result.scalar_one_or_none()
-        if not upload:
+        row = result.first()
+        if not row:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Upload not found"
             )
+        upload, existing_doc_id, audit_id = row
         
-        # Check if document already exists
-        result = await self.db.execute(
-            select(models.Document).where(
-                models.Document.owner_id == owner_id,
-                models.Document.title == upload.original_filename
-            )
-        )
-        existing_doc = result.scalars().first()
-        if existing_doc:
-            return existing_doc
+        # Only the id is joined; load the existing document on a hit
+        if existing_doc_id:
+            return await self.get_document(existing_doc_id)
         
-        # Get content from AuditResult
-        result = await self.db.execute(
-            select(models.AuditResult).where(
-                models.AuditResult.upload_id == upload_id
+        # Audit results only point at the upload; read the text from the file
+        content = ""
+        if audit_id and upload.file_path:
+            content = await FileProcessor.extract_text_from_file(
+                upload.file_path,
+                upload.mime_type or "text/plain"
             )
-        )
-        audit = result.scalars().first()
-        content = audit.input_text if audit else ""
         
         # Consume credits
         credit_cost = await get_credit_cost("document_creation", self.db)
@@ -268,7 +344,7 @@ class DocumentService:
             owner_id=owner_id
         )
     
-    async def get_versions(self, doc_id: int) -> List[Dict[str, Any]]:
+    async def get_versions(self, doc_id: int) -> List[models.DocumentVersion]:
         """
         Get version history for a document.
         
@@ -276,40 +352,41 @@ class DocumentService:
             doc_id: Document ID
             
         Returns:
-            List of version dictionaries with user info
+            List of versions with their creator eagerly loaded
         """
         result = await self.db.execute(
-            select(models.DocumentVersion, models.User)
-            .join(
-                models.User,
-                models.DocumentVersion.created_by == models.User.id,
-                isouter=True
-            )
+            select(models.DocumentVersion)
+            .options(selectinload(models.DocumentVersion.creator))
             .where(models.DocumentVersion.document_id == doc_id)
             .order_by(models.DocumentVersion.created_at.desc())
         )
+        return result.scalars().all()
+    
+    async def charge_ai_suggestion(self, doc: models.Document, user_id: int) -> None:
+        """
+        Consume the credits for an AI suggestion on a document.
         
-        versions_with_users = result.all()
-        
-        # Build response with user info
-        response = []
-        for version, user in versions_with_users:
-            version_dict = {
-                "id": version.id,
-                "document_id": version.document_id,
-                "content": version.content,
-                "created_at": version.created_at,
-                "created_by": version.created_by,
-                "created_by_email": user.email if user else None,
-                "created_by_name": user.full_name if user else None
-            }
-            response.append(version_dict)
-        
-        return response
+        Args:
+            doc: Document the suggestion is for
+            user_id: User ID (for credit consumption)
+        """
+        credit_cost = await get_credit_cost("ai_suggestion", self.db)
+        await consume_credits(
+            user_id=user_id,
+            amount=credit_cost,
+            operation_type="ai_suggestion",
+            description=f"AI suggestion for document: {doc.title}",
+            metadata={
+                "operation_type": "ai_suggestion",
+                "document_id": doc.id,
+                "document_title": doc.title
+            },
+            db=self.db
+        )
     
     async def get_ai_suggestions(
         self,
-        doc_id: int,
+        doc: models.Document,
         context: str,
         selection: str,
         user_id: int
@@ -318,36 +395,15 @@ class DocumentService:
         Get AI-powered suggestions for document text.
         
         Args:
-            doc_id: Document ID
+            doc: Document the suggestion is for
             context: Context text
             selection: Selected text
             user_id: User ID (for credit consumption)
             
         Returns:
             AI suggestions
-            
-        Raises:
-            HTTPException: If document not found
         """
-        from app.services.ai import generate_suggestion
-        
-        # Verify document exists
-        doc = await self.get_document(doc_id)
-        
-        # Consume credits
-        credit_cost = await get_credit_cost("ai_suggestion", self.db)
-        await consume_credits(
-            user_id=user_id,
-            amount=credit_cost,
-            operation_type="ai_suggestion",
-            description=f"AI suggestion for document: {doc.title}",
-            metadata={
-                "operation_type": "ai_suggestion",
-                "document_id": doc_id,
-                "document_title": doc.title
-            },
-            db=self.db
-        )
+        await self.charge_ai_suggestion(doc, user_id)
         
         # Generate suggestions
         suggestions = await generate_suggestion(context, selection)
@@ -1,9 +1,22 @@
 from openai import AsyncOpenAI
 from openai import OpenAIError
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional
+import asyncio
+import hashlib
 import json
+import logging
 import re
+import orjson
 from app.config import settings
+from app.cache import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Successful analyses are reused for identical texts
+ANALYSIS_CACHE_TTL = 24 * 60 * 60  # seconds
+
+def _analysis_cache_key(text: str) -> str:
+    return f"hf:analyze:v1:{hashlib.sha256(text.encode()).hexdigest()}"
 
 class HuggingFaceService:
     """Service to interact with Hugging Face Inference API via OpenAI SDK"""
@@ -40,6 +53,16 @@ class HuggingFaceService:
     
     async def analyze_text(self, text: str) -> Dict[str, Any]:
         """Analyze text and return structured results with guaranteed JSON format"""
+        cached = (await self._get_cached_analyses([text]))[0]
+        if cached is not None:
+            return cached
+        
+        analysis = await self._analyze_text_uncached(text)
+        await self._cache_analyses([text], [analysis])
+        return analysis
+    
+    async def _analyze_text_uncached(self, text: str) -> Dict[str, Any]:
+        """Query the model for the analysis of a single text"""
         # Create a structured prompt that forces JSON output
         structured_prompt = f"""
         Analyze the following text and provide a structured JSON response with exactly these keys:
@@ -63,29 +86,122 @@ class HuggingFaceService:
         result = await self.query_model(structured_prompt)
         
         if "error" in result:
-            return {
-                "status": "error",
-                "message": result["error"],
-                "analysis": "Analysis failed due to API error",
-                "suggestions": [],
-                "quality_score": 0
-            }
+            return self._error_analysis(result["error"])
 
         content = result.get("content", "")
         # Try to extract and parse JSON from the response
         parsed_result = self._extract_and_parse_json(content)
 
         if parsed_result:
-            return {
-                "status": "success",
-                "analysis": parsed_result.get("analysis", "No analysis provided"),
-                "suggestions": parsed_result.get("suggestions", []),
-                "quality_score": parsed_result.get("quality_score", 5)
-            }
+            return self._analysis_from_parsed(parsed_result)
         else:
             # Fallback: use regex extraction if JSON parsing fails
             return self._fallback_analysis(content)
     
+    async def analyze_texts(self, texts: List[str]) -> List[Dict[str, Any]]:
+        """
+        Analyze several texts with a single model request.
+        
+        Texts with a cached analysis are not sent to the model. Falls back to one request per text if the batched request fails or
+        its reply cannot be matched up with its inputs.
+        """
+        results = await self._get_cached_analyses(texts)
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            analyses = await self._analyze_texts_uncached([texts[i] for i in missing])
+            for i, analysis in zip(missing, analyses):
+                results[i] = analysis
+            await self._cache_analyses([texts[i] for i in missing], analyses)
+        return results
+    
+    async def _analyze_texts_uncached(self, texts: List[str]) -> List[Dict[str, Any]]:
+        """Query the model for the analyses of several texts"""
+        if len(texts) == 1:
+            return [await self._analyze_text_uncached(texts[0])]
+        
+        sections = "\n\n".join(
+            f'Text {i}:\n"""{text}"""' for i, text in enumerate(texts, 1)
+        )
+        structured_prompt = f"""
+        Analyze each of the following {len(texts)} texts independently. Respond with a JSON array
+        containing exactly {len(texts)} objects, one per text and in the same order, each with exactly these keys:
+        - "analysis": string describing the overall analysis
+        - "suggestions": array of strings with specific improvement suggestions
+        - "quality_score": integer between 1-10 representing overall quality
+
+        {sections}
+
+        Return ONLY a valid JSON array without any additional text, markdown, or explanations.
+
+        Your JSON response:
+        """
+        
+        result = await self.query_model(structured_prompt)
+        
+        # On a failed request or a reply that does not match up with the
+        # texts, fall back to one request per text
+        parsed_results = None
+        if "error" not in result:
+            parsed_results = self._extract_and_parse_json_array(result.get("content") or "")
+        if (
+            parsed_results
+            and len(parsed_results) == len(texts)
+            and all(isinstance(parsed, dict) for parsed in parsed_results)
+        ):
+            return [self._analysis_from_parsed(parsed) for parsed in parsed_results]
+        
+        return list(await asyncio.gather(*(self._analyze_text_uncached(text) for text in texts)))
+    
+    async def _get_cached_analyses(self, texts: List[str]) -> List[Optional[Dict[str, Any]]]:
+        """Look up cached analyses; None for texts without one"""
+        try:
+            redis_client = await get_redis()
+            cached = await redis_client.mget([_analysis_cache_key(text) for text in texts])
+        except Exception:
+            return [None] * len(texts)
+        return [orjson.loads(value) if value else None for value in cached]
+    
+    async def _cache_analyses(self, texts: List[str], analyses: List[Dict[str, Any]]) -> None:
+        """Cache the successful analyses; failures are retried next time"""
+        try:
+            redis_client = await get_redis()
+            async with redis_client.pipeline(transaction=False) as pipe:
+                for text, analysis in zip(texts, analyses):
+                    if analysis.get("status") == "success":
+                        pipe.setex(_analysis_cache_key(text), ANALYSIS_CACHE_TTL, orjson.dumps(analysis))
+                await pipe.execute()
+        except Exception:
+            pass
+    
+    def _error_analysis(self, message: str) -> Dict[str, Any]:
+        """Result returned when the model request fails"""
+        return {
+            "status": "error",
+            "message": message,
+            "analysis": "Analysis failed due to API error",
+            "suggestions": [],
+            "quality_score": 0
+        }
+    
+    def _analysis_from_parsed(self, parsed_result: Dict[str, Any]) -> Dict[str, Any]:
+        """Normalize a parsed model reply into the analysis format"""
+        return {
+            "status": "success",
+            "analysis": parsed_result.get("analysis", "No analysis provided"),
+            "suggestions": parsed_result.get("suggestions", []),
+            "quality_score": parsed_result.get("quality_score", 5)
+        }
+    
+    def _extract_and_parse_json_array(self, content: str) -> Optional[List[Any]]:
+        """Extract a JSON array from model response and parse it"""
+        try:
+            json_match = re.search(r'\[.*\]', content, re.DOTALL)
+            parsed = json.loads(json_match.group() if json_match else content)
+            return parsed if isinstance(parsed, list) else None
+        except json.JSONDecodeError as e:
+            logger.warning("JSON array parsing failed: %s", e)
+            return None
+    
     def _extract_and_parse_json(self, content: str) -> Dict[str, Any]:
         """Extract JSON from model response and parse it"""
         try:
@@ -1,12 +1,61 @@
-import os
+import asyncio
+import logging
 import aiofiles
+import aiofiles.os
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Set
 from fastapi import UploadFile
+from fastapi.concurrency import run_in_threadpool
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import update, func, bindparam, lambda_stmt
 from app.config import settings
+from app.db import async_session_maker
+from app.models import Upload, AuditResult
+from app.services.file_processor import FileProcessor
+from app.services.huggingface import hf_service
 
-async def save_upload_file(file: UploadFile, user_id: str) -> tuple[str, int]:
-    """Save uploaded file and return path and size"""
+logger = logging.getLogger(__name__)
+
+# Uploads are copied to disk in chunks of this size, bounding memory per upload
+UPLOAD_CHUNK_SIZE = 64 * 1024  # bytes
+
+SET_UPLOAD_STATUS_STMT = lambda_stmt(
+    lambda: update(Upload)
+    .where(Upload.id == bindparam("upload_id"))
+    .values(status=bindparam("new_status"), error_message=bindparam("new_error_message"))
+)
+
+# Jobs live in this process only, so a restart or crash leaves their uploads
+# in "processing". Uploads untouched for this long are assumed orphaned and
+# processed again (their credits were already charged when claimed)
+STALE_PROCESSING_AFTER = timedelta(minutes=15)
+STALE_CHECK_INTERVAL = 60  # seconds
+
+# Re-claim orphaned uploads; bumping updated_at keeps other workers from
+# picking up the same rows
+RECLAIM_STALE_UPLOADS_STMT = lambda_stmt(
+    lambda: update(Upload)
+    .where(
+        Upload.status == "processing",
+        func.coalesce(Upload.updated_at, Upload.created_at) < bindparam("stale_before")
+    )
+    .values(updated_at=func.now())
+    .returning(Upload.id, Upload.user_id)
+)
+
+_stale_upload_reaper: Optional[asyncio.Task] = None
+
+# Strong references to running processing jobs so they are not garbage collected
+_processing_jobs: Set[asyncio.Task] = set()
+
+async def save_upload_file(file: UploadFile, user_id: str, max_size: Optional[int] = None) -> tuple[str, int]:
+    """
+    Stream uploaded file to disk and return path and size
+    Stops as soon as the file exceeds max_size (defaults to MAX_FILE_SIZE)
+    """
+    if max_size is None:
+        max_size = settings.MAX_FILE_SIZE
+    
     upload_dir = Path(settings.UPLOAD_DIR) / str(user_id)
     upload_dir.mkdir(parents=True, exist_ok=True)
     
@@ -14,13 +63,14 @@ async def save_upload_file(file: UploadFile, user_id: str) -> tuple[str, int]:
     
     size = 0
     async with aiofiles.open(file_path, 'wb') as f:
-        while chunk := await file.read(8192):
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
             size += len(chunk)
-            if size > settings.MAX_FILE_SIZE:
+            if size > max_size:
                 # Clean up and raise error
                 await file.close()
-                os.remove(file_path)
-                raise ValueError(f"File size exceeds {settings.MAX_FILE_SIZE} bytes")
+                await f.close()
+                await aiofiles.os.remove(file_path)
+                raise ValueError(f"File size exceeds {max_size} bytes")
             await f.write(chunk)
     
     return str(file_path), size
@@ -29,4 +79,119 @@ async def read_file_content(file_path: str) -> str:
     """Read content from uploaded file"""
     async with aiofiles.open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
         content = await f.read()
-    return content
\ No newline at end of file
+    return content
+
+
+def submit_file_processing(upload_id: int, user_id: int) -> None:
+    """
+    Run run_file_processing in the background
+    The upload must already be claimed (status "processing"); its status
+    moves to "completed" or "failed" when the job finishes
+    """
+    task = asyncio.create_task(run_file_processing(upload_id, user_id))
+    _processing_jobs.add(task)
+    task.add_done_callback(_processing_jobs.discard)
+
+async def run_file_processing(upload_id: int, user_id: int) -> None:
+    """Extract, analyze and store the results of a claimed upload"""
+    # Runs after the request has finished, so it needs its own session
+    async with async_session_maker() as db:
+        try:
+            upload = await db.get(Upload, upload_id)
+            if not upload:
+                return
+            
+            # Step 1: Extract text from file (REAL PROCESSING)
+            file_processor = FileProcessor()
+            text_content = await file_processor.extract_text_from_file(
+                upload.file_path,
+                upload.mime_type or "text/plain"
+            )
+            
+            if not text_content or len(text_content.strip()) < 10:
+                raise ValueError("File appears to be empty or contains insufficient text")
+            
+            # Steps 2 and 3 are independent, so run them concurrently:
+            # document analysis (REAL ANALYSIS) is CPU-bound and offloaded to
+            # the thread pool while the Hugging Face request (REAL AI) is in flight
+            document_analysis, ai_analysis = await asyncio.gather(
+                run_in_threadpool(file_processor.analyze_document, text_content),
+                hf_service.analyze_text(text_content[:1000])  # First 1000 chars for AI
+            )
+            
+            # Combine results
+            combined_result = {
+                **ai_analysis,
+                "document_metrics": document_analysis,
+                "text_preview": text_content[:500],
+                "total_characters": len(text_content)
+            }
+            
+            # Step 4: Save result to database. The full text stays in the
+            # upload's file; upload_id is the pointer to it
+            db.add(AuditResult(
+                user_id=user_id,
+                upload_id=upload_id,
+                result_json=combined_result,
+                status="completed"
+            ))
+            
+            # Step 5: Update upload status, in the same commit as the audit row
+            await db.execute(
+                SET_UPLOAD_STATUS_STMT,
+                {"upload_id": upload_id, "new_status": "completed", "new_error_message": None}
+            )
+            await db.commit()
+        except Exception as e:
+            # Mark as failed with error message
+            await db.rollback()
+            await db.execute(
+                SET_UPLOAD_STATUS_STMT,
+                {"upload_id": upload_id, "new_status": "failed", "new_error_message": str(e)}
+            )
+            await db.commit()
+
+async def resubmit_stale_uploads() -> int:
+    """
+    Restart processing of uploads orphaned in "processing"
+    Returns the number of uploads resubmitted
+    """
+    async with async_session_maker() as db:
+        result = await db.execute(
+            RECLAIM_STALE_UPLOADS_STMT,
+            {"stale_before": datetime.now(timezone.utc) - STALE_PROCESSING_AFTER}
+        )
+        stale = result.all()
+        await db.commit()
+    
+    for upload_id, user_id in stale:
+        submit_file_processing(upload_id, user_id)
+    return len(stale)
+
+async def _reap_stale_uploads() -> None:
+    """Periodically resubmit orphaned uploads"""
+    while True:
+        try:
+            await resubmit_stale_uploads()
+        except Exception:
+            logger.warning("Could not resubmit stale uploads", exc_info=True)
+        await asyncio.sleep(STALE_CHECK_INTERVAL)
+
+def start_stale_upload_reaper() -> None:
+    """Start the background check for orphaned uploads"""
+    global _stale_upload_reaper
+    if _stale_upload_reaper is None or _stale_upload_reaper.done():
+        _stale_upload_reaper = asyncio.create_task(_reap_stale_uploads())
+
+async def close_processing_jobs() -> None:
+    """Stop the stale upload check and let running processing jobs finish before shutdown"""
+    global _stale_upload_reaper
+    if _stale_upload_reaper is not None:
+        _stale_upload_reaper.cancel()
+        try:
+            await _stale_upload_reaper
+        except asyncio.CancelledError:
+            pass
+        _stale_upload_reaper = None
+    if _processing_jobs:
+        await asyncio.gather(*_processing_jobs, return_exceptions=True)
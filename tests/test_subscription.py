@@ -0,0 +1,98 @@
+import os
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from fastapi import HTTPException
+
+# Settings are read at import time; no database or Redis is contacted
+for name, value in {
+    "DATABASE_URL": "sqlite+aiosqlite:///:memory:",
+    "JWT_SECRET_KEY": "test",
+    "HF_API_KEY": "test",
+    "HF_BASE_URL": "http://localhost",
+    "HF_MODEL_NAME": "test",
+    "STRIPE_SECRET_KEY": "test",
+    "STRIPE_PUBLISHABLE_KEY": "test",
+    "STRIPE_WEBHOOK_SECRET": "test",
+}.items():
+    os.environ.setdefault(name, value)
+
+from sqlalchemy.dialects import postgresql
+
+from app.middleware import subscription
+
+
+class StubResult:
+    def __init__(self, row):
+        self._row = row
+
+    def one(self):
+        return self._row
+
+
+class StubSession:
+    """Records executed statements and returns a fixed (subscription_id, available) row"""
+
+    def __init__(self, user_id, credits_per_month, row):
+        plan = SimpleNamespace(credits_per_month=credits_per_month)
+        self.info = {"user_plans": {user_id: (SimpleNamespace(id=7), plan)}}
+        self.row = row
+        self.statements = []
+        self.commits = 0
+
+    async def execute(self, statement):
+        self.statements.append(statement)
+        return StubResult(self.row)
+
+    async def commit(self):
+        self.commits += 1
+
+
+@subscription.consume_credits(amount=2, operation_type="test")
+async def endpoint(db=None, current_user=None):
+    return "done"
+
+
+class ConsumeCreditsTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.user = SimpleNamespace(id=1)
+        patcher = mock.patch.object(subscription, "credit_consumer")
+        self.consumer = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_charges_and_records_usage(self):
+        db = StubSession(self.user.id, 100, (7, 10))
+
+        self.assertEqual(await endpoint(db=db, current_user=self.user), "done")
+
+        self.assertEqual(db.commits, 1)
+        sql = str(db.statements[0].compile(dialect=postgresql.dialect()))
+        self.assertIn("UPDATE subscriptions", sql)
+        self.assertIn("greatest", sql)
+        self.consumer.record.assert_called_once()
+        self.assertEqual(self.consumer.record.call_args.kwargs["subscription_id"], 7)
+        self.assertEqual(self.consumer.record.call_args.kwargs["amount"], -2)
+
+    async def test_insufficient_credits_reports_balance_from_update(self):
+        db = StubSession(self.user.id, 100, (None, 1))
+
+        with self.assertRaises(HTTPException) as raised:
+            await endpoint(db=db, current_user=self.user)
+
+        self.assertEqual(raised.exception.status_code, 402)
+        self.assertIn("Available: 1", raised.exception.detail)
+        self.assertEqual(db.commits, 0)
+        self.consumer.record.assert_not_called()
+
+    async def test_unlimited_plan_is_not_charged(self):
+        db = StubSession(self.user.id, -1, None)
+
+        self.assertEqual(await endpoint(db=db, current_user=self.user), "done")
+
+        self.assertEqual(db.statements, [])
+        self.consumer.record.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()